@@ -1,31 +1,768 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, g
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 import sqlite3
+import os
+import click
+import re
+import logging
+from logging.handlers import RotatingFileHandler
+import queue
+import base64
+import csv
+import io
+import uuid
+import gzip
+import hashlib
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from json import dumps, loads
+from functools import lru_cache, wraps
+from collections import OrderedDict
+from datetime import date, datetime, timezone
+from urllib.parse import quote
 
 app = Flask(__name__)
 CORS(app)
 DATABASE = 'shop.db'
+POOL_SIZE = 8
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+IMPORT_CHUNK_SIZE = 1000
+IMPORT_ERRORS_SHOWN = 10
+STREAM_BATCH_SIZE = 500
+FILTER_PLAN_CACHE_SIZE = 256
+RESPONSE_CACHE_SIZE = 512
+RESPONSE_CACHE_MAX_BYTES = 1048576
+RESPONSE_CACHE_BUDGET_BYTES = 67108864
+GZIP_MIN_BYTES = 1024
+WRITE_BATCH_SIZE = 64
+WRITE_BATCH_WAIT = 0.002
+WRITE_TIMEOUT = 30
+DATA_VERSION_INTERVAL = 0.5
+COMPACT_CHUNK_SIZE = 10000
+ARCHIVE_AFTER_DAYS = 365
+MIN_SQLITE_VERSION = (3, 35, 0)
+METRICS_ENABLED = os.environ.get("CRUD_METRICS", "on") != "off"
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+VM_STEP_INTERVAL = 1000
+SLOW_QUERY_MS = os.environ.get("CRUD_SLOW_QUERY_MS", "100")
+SLOW_QUERY_LOG = os.environ.get("CRUD_SLOW_QUERY_LOG", "slow_queries.log")
+SLOW_QUERY_LOG_BYTES = 1048576
+SLOW_QUERY_LOG_FILES = 3
+ROUTE_STATEMENTS_MAX = 50
+STORAGE_PROFILE = os.environ.get("CRUD_STORAGE_PROFILE", "balanced")
 table_schemes: dict = {}
+table_columns: dict = {}
+fts_tables: dict = {}
+connection_pools: dict = {}
+writer_connections: dict = {}
+data_versions: dict = {}
+write_queue: queue.Queue = queue.Queue()
+write_lock = threading.Lock()
+write_threads: list = []
+table_versions: dict = {}
+response_cache: OrderedDict = OrderedDict()
+response_cache_stats: dict = {"hits": 0, "misses": 0, "not modified": 0, "bytes": 0}
+etag_epoch: str = uuid.uuid4().hex
+cache_lock = threading.Lock()
+request_metrics: dict = {}
+sql_metrics: dict = {}
+vm_step_metrics: dict = {}
+metrics_lock = threading.Lock()
+sql_context = threading.local()
+slow_queries: dict = {}
+route_statements: dict = {}
+slow_query_threshold: float = None if SLOW_QUERY_MS == "off" else float(SLOW_QUERY_MS) / 1000
+slow_query_log = logging.getLogger("crud.slow_queries")
+
+# Pragmas applied to every connection per storage profile, busy_timeout first and WAL in all of them
+
+storage_profiles: dict = {
+    "balanced": {
+        "busy_timeout": 5000,
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -16000,
+        "mmap_size": 0,
+        "temp_store": "MEMORY",
+    },
+    "read-heavy": {
+        "busy_timeout": 5000,
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -64000,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+    },
+    "write-heavy": {
+        "busy_timeout": 10000,
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -32000,
+        "mmap_size": 67108864,
+        "temp_store": "MEMORY",
+        "wal_autocheckpoint": 10000,
+    },
+    "durable": {
+        "busy_timeout": 10000,
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "cache_size": -16000,
+        "mmap_size": 0,
+        "temp_store": "FILE",
+    },
+}
+
+# Columns of the transactions ledger and its yearly archives, transaction_time is the unix time of the row
+
+transactions_columns: str = "transaction_id INTEGER NOT NULL PRIMARY KEY, transaction_date TEXT DEFAULT CURRENT_DATE, product_id INTEGER, product_name TEXT, quantity INTEGER, client_id INTEGER, client_name TEXT, type_of_transaction TEXT, transaction_time INTEGER"
+
+# Daily rollups of the ledger by product and by client, fed by a trigger on every transaction insert
+
+rollup_tables: dict = {
+    "product_daily_rollups": "product_id",
+    "client_daily_rollups": "client_id",
+}
+rollup_transaction_types: tuple = ("buy", "return", "add", "remove")
+
+# Report groupings: rollup table read, grouping expression and the columns describing each group
+
+report_groups: dict = {
+    "product": ("product_daily_rollups", "r.product_id", "r.product_id AS product_id, products.name AS product_name", "LEFT JOIN products ON products.id = r.product_id"),
+    "client": ("client_daily_rollups", "r.client_id", "r.client_id AS client_id, clients.name AS client_name", "LEFT JOIN clients ON clients.id = r.client_id"),
+    "day": ("product_daily_rollups", "r.day", "r.day AS day", ""),
+    "month": ("product_daily_rollups", "substr(r.day, 1, 7)", "substr(r.day, 1, 7) AS month", ""),
+    "year": ("product_daily_rollups", "substr(r.day, 1, 4)", "substr(r.day, 1, 4) AS year", ""),
+}
+
+# Compact ledger layout: integer keys, a name dictionary and a type enum behind a transactions view
+
+compact_ledger_tables: list = [
+    "CREATE TABLE IF NOT EXISTS ledger_names (id INTEGER NOT NULL PRIMARY KEY, name TEXT NOT NULL UNIQUE)",
+    "CREATE TABLE IF NOT EXISTS transaction_types (id INTEGER NOT NULL PRIMARY KEY, name TEXT NOT NULL UNIQUE)",
+    "INSERT OR IGNORE INTO transaction_types (id, name) VALUES (1, 'buy'), (2, 'return'), (3, 'add'), (4, 'remove'), (5, 'update name'), (6, 'update quantity'), (7, 'update name and quantity')",
+    "CREATE TABLE IF NOT EXISTS transaction_rows (transaction_id INTEGER NOT NULL PRIMARY KEY, transaction_time INTEGER, product_id INTEGER, product_name_id INTEGER, quantity INTEGER, client_id INTEGER, client_name_id INTEGER, type INTEGER)",
+]
+compact_ledger_view: list = [
+    "CREATE VIEW transactions AS SELECT r.transaction_id AS transaction_id, date(r.transaction_time, 'unixepoch') AS transaction_date, r.product_id AS product_id, product_names.name AS product_name, r.quantity AS quantity, r.client_id AS client_id, client_names.name AS client_name, transaction_types.name AS type_of_transaction, r.transaction_time AS transaction_time FROM transaction_rows r LEFT JOIN ledger_names product_names ON product_names.id = r.product_name_id LEFT JOIN ledger_names client_names ON client_names.id = r.client_name_id LEFT JOIN transaction_types ON transaction_types.id = r.type",
+    "CREATE TRIGGER transactions_insert INSTEAD OF INSERT ON transactions BEGIN INSERT OR IGNORE INTO ledger_names (name) VALUES (new.product_name), (new.client_name); INSERT OR IGNORE INTO transaction_types (name) VALUES (new.type_of_transaction); INSERT INTO transaction_rows (transaction_id, transaction_time, product_id, product_name_id, quantity, client_id, client_name_id, type) VALUES (new.transaction_id, COALESCE(new.transaction_time, CAST(strftime('%s', CASE WHEN new.transaction_date IS NULL OR new.transaction_date = CURRENT_DATE THEN 'now' ELSE new.transaction_date END) AS INTEGER)), new.product_id, (SELECT id FROM ledger_names WHERE name = new.product_name), new.quantity, new.client_id, (SELECT id FROM ledger_names WHERE name = new.client_name), (SELECT id FROM transaction_types WHERE name = new.type_of_transaction)); END",
+    "CREATE TRIGGER transactions_delete INSTEAD OF DELETE ON transactions BEGIN DELETE FROM transaction_rows WHERE transaction_id = old.transaction_id; END",
+]
+
+# Secondary indexes maintained by init_db, only the retired ones below are dropped
+
+table_indexes: dict = {
+    "idx_transactions_client_product_type": "CREATE INDEX IF NOT EXISTS idx_transactions_client_product_type ON transactions (client_id, product_id, type_of_transaction, quantity)",
+    "idx_transactions_time": "CREATE INDEX IF NOT EXISTS idx_transactions_time ON transactions (transaction_time)",
+    "idx_transaction_rows_client_product_type": "CREATE INDEX IF NOT EXISTS idx_transaction_rows_client_product_type ON transaction_rows (client_id, product_id, type, quantity)",
+    "idx_transaction_rows_time": "CREATE INDEX IF NOT EXISTS idx_transaction_rows_time ON transaction_rows (transaction_time)",
+}
+
+retired_indexes: tuple = ("idx_transactions_date",)
+
+# Tables whose name column gets a trigram full text index for the text operators
+
+fts_indexed_tables: list = ["products", "clients"]
 
 ## Initialization
 
 def init_db():
+    if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+        raise RuntimeError(f"SQLite {'.'.join(map(str, MIN_SQLITE_VERSION))} or newer is required (UPDATE ... RETURNING), this Python uses SQLite {sqlite3.sqlite_version}")
     with sqlite3.connect(DATABASE) as conn:
+        apply_pragmas(conn)
         cursor = conn.cursor()
         cursor.execute("CREATE TABLE IF NOT EXISTS products (id INTEGER NOT NULL PRIMARY KEY, name TEXT NOT NULL UNIQUE, quantity INTEGER)")
         cursor.execute("CREATE TABLE IF NOT EXISTS clients (id INTEGER NOT NULL PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
-        cursor.execute("CREATE TABLE IF NOT EXISTS transactions (transaction_id INTEGER NOT NULL PRIMARY KEY, transaction_date TEXT DEFAULT CURRENT_DATE, product_id INTEGER, product_name TEXT, quantity INTEGER, client_id INTEGER, client_name TEXT, type_of_transaction TEXT)")
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS transactions ({transactions_columns})")
+        balances_exist = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'purchase_balances'").fetchone()
+        cursor.execute("CREATE TABLE IF NOT EXISTS purchase_balances (client_id INTEGER NOT NULL, product_id INTEGER NOT NULL, bought INTEGER NOT NULL DEFAULT 0, returned INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (client_id, product_id)) WITHOUT ROWID")
+        if not balances_exist:
+            rebuild_purchase_balances(cursor)
+        init_transaction_time(cursor)
+        init_indexes(cursor)
+        init_fts(cursor)
+        init_rollups(cursor)
         conn.commit()
-    
-        cursor = conn.cursor()
-        list_of_tables = cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
-        table_names = [table[0] for table in list_of_tables]
-        for name in table_names[1:]:
-            result_sql = cursor.execute(f"PRAGMA table_info({name})").fetchall()
-            table_scheme: list = []
-            for entry in result_sql:
-                table_scheme.append((entry[1], entry[2]))
-            table_schemes[name] = table_scheme
+        load_table_schemes(conn.cursor())
+
+# Read the columns of every table and view, view columns take the type of the ledger column of their name
+
+def load_table_schemes(cursor) -> None:
+    ledger_types: dict = dict(column.split()[:2] for column in transactions_columns.split(", "))
+    list_of_tables = cursor.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite_%'").fetchall()
+    table_names = [table[0] for table in list_of_tables]
+    for name in table_names:
+        result_sql = cursor.execute(f"PRAGMA table_info({name})").fetchall()
+        table_scheme: list = []
+        for entry in result_sql:
+            table_scheme.append((entry[1], entry[2] or ledger_types.get(entry[1], "")))
+        table_schemes[name] = table_scheme
+        table_columns[name] = [column_name for column_name, _ in table_scheme]
+    filter_plan.cache_clear()
+
+# Create the declared indexes, drop the retired ones and refresh the planner statistics
+
+def init_indexes(cursor) -> None:
+    for index_sql in table_indexes.values():
+        table: str = index_sql.split(" ON ")[1].split()[0]
+        if cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone():
+            cursor.execute(index_sql)
+    for index_name in retired_indexes:
+        cursor.execute(f"DROP INDEX IF EXISTS {index_name}")
+    cursor.execute("PRAGMA optimize")
+
+# Trigram shadow index over name kept in sync by triggers, skipped when SQLite is built without FTS5
+
+def init_fts(cursor) -> None:
+    for table in fts_indexed_tables:
+        fts_table: str = f"{table}_fts"
+        exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (fts_table,)).fetchone()
+        try:
+            cursor.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5(name, content = '{table}', content_rowid = 'id', tokenize = 'trigram')")
+        except sqlite3.OperationalError:
+            continue
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {fts_table}_insert AFTER INSERT ON {table} BEGIN INSERT INTO {fts_table} (rowid, name) VALUES (new.id, new.name); END")
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {fts_table}_delete AFTER DELETE ON {table} BEGIN INSERT INTO {fts_table} ({fts_table}, rowid, name) VALUES ('delete', old.id, old.name); END")
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {fts_table}_update AFTER UPDATE OF name ON {table} BEGIN INSERT INTO {fts_table} ({fts_table}, rowid, name) VALUES ('delete', old.id, old.name); INSERT INTO {fts_table} (rowid, name) VALUES (new.id, new.name); END")
+        if not exists:
+            cursor.execute(f"INSERT INTO {fts_table} ({fts_table}) VALUES ('rebuild')")
+        fts_tables[table] = fts_table
+
+# Add and fill transaction_time on older ledgers, a trigger stamps the new rows of the text layout
+
+def init_transaction_time(cursor) -> None:
+    layout: str = ledger_layout(cursor)
+    for table in (["transactions"] if layout == "text" else []) + archive_tables(cursor):
+        if "transaction_time" not in [row[1] for row in cursor.execute(f"PRAGMA table_info({table})").fetchall()]:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN transaction_time INTEGER")
+            cursor.execute(f"UPDATE {table} SET transaction_time = CAST(strftime('%s', transaction_date) AS INTEGER)")
+        if table != "transactions":
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {table}_time ON {table} (transaction_time)")
+    if layout == "text":
+        cursor.execute("CREATE TRIGGER IF NOT EXISTS transactions_time AFTER INSERT ON transactions WHEN new.transaction_time IS NULL BEGIN UPDATE transactions SET transaction_time = CAST(strftime('%s', CASE WHEN new.transaction_date = CURRENT_DATE THEN 'now' ELSE new.transaction_date END) AS INTEGER) WHERE transaction_id = new.transaction_id; END")
+    elif "transaction_time" not in [row[1] for row in cursor.execute("PRAGMA table_info(transactions)").fetchall()]:
+        cursor.execute("DROP VIEW transactions")
+        for statement in compact_ledger_view:
+            cursor.execute(statement)
+
+# Daily rollup tables kept current by a ledger trigger, filled from the ledger and its archives when created
+
+def init_rollups(cursor) -> None:
+    transaction_types: str = ", ".join(f"'{type_of_transaction}'" for type_of_transaction in rollup_transaction_types)
+    trigger_timing: str = "INSTEAD OF" if ledger_layout(cursor) == "compact" else "AFTER"
+    for rollup_table, key_column in rollup_tables.items():
+        exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (rollup_table,)).fetchone()
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {rollup_table} (day TEXT NOT NULL, {key_column} INTEGER NOT NULL, type_of_transaction TEXT NOT NULL, units INTEGER NOT NULL DEFAULT 0, transactions INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (day, {key_column}, type_of_transaction)) WITHOUT ROWID")
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {rollup_table}_insert {trigger_timing} INSERT ON transactions WHEN new.type_of_transaction IN ({transaction_types}) AND new.{key_column} IS NOT NULL BEGIN INSERT INTO {rollup_table} (day, {key_column}, type_of_transaction, units, transactions) VALUES (COALESCE(new.transaction_date, CURRENT_DATE), new.{key_column}, new.type_of_transaction, COALESCE(new.quantity, 0), 1) ON CONFLICT DO UPDATE SET units = units + excluded.units, transactions = transactions + 1; END")
+        if not exists:
+            cursor.execute(f"INSERT INTO {rollup_table} (day, {key_column}, type_of_transaction, units, transactions) SELECT transaction_date, {key_column}, type_of_transaction, SUM(COALESCE(quantity, 0)), COUNT(*) FROM ({ledger_sql(cursor, f'transaction_date, {key_column}, type_of_transaction, quantity')}) WHERE type_of_transaction IN ({transaction_types}) AND transaction_date IS NOT NULL AND {key_column} IS NOT NULL GROUP BY transaction_date, {key_column}, type_of_transaction")
+
+## Instrumentation
+
+# Count and time every statement against the route running it, fetches included
+
+def record_sql(sql: str, elapsed: float, rows: int = 0, executed: bool = False) -> None:
+    route: str = getattr(sql_context, "route", "background")
+    kind: str = (sql.split(None, 1) or ["NONE"])[0].upper()
+    with metrics_lock:
+        metrics: list = sql_metrics.setdefault((route, kind), [0, 0.0, 0])
+        metrics[0] += executed
+        metrics[1] += elapsed
+        metrics[2] += rows
+    record_phase("sql", elapsed)
+
+# Add time spent in a phase of the current request, nothing is recorded outside a request
+
+def record_phase(phase: str, elapsed: float) -> None:
+    phases = getattr(sql_context, "phases", None)
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0.0) + elapsed
+
+# Count a validation helper as the validation phase, nested helpers only once
+
+def validation_phase(function):
+    if not METRICS_ENABLED:
+        return function
+
+    @wraps(function)
+    def timed_validation(*args, **kwargs):
+        phases = getattr(sql_context, "phases", None)
+        if phases is None or getattr(sql_context, "validating", False):
+            return function(*args, **kwargs)
+        sql_context.validating = True
+        other_phases: float = sum(phases.values())
+        started: float = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            sql_context.validating = False
+            record_phase("validation", max(time.perf_counter() - started - (sum(phases.values()) - other_phases), 0.0))
+    return timed_validation
+
+# Keep the first execution of each distinct statement of a route for the index report
+
+def record_route_statement(sql: str, parameters) -> None:
+    route: str = getattr(sql_context, "route", "background")
+    statement: str = normalize_statement(sql)
+    if "temp." in statement:
+        return
+    with metrics_lock:
+        statements: dict = route_statements.setdefault(route, {})
+        if statement not in statements and len(statements) < ROUTE_STATEMENTS_MAX:
+            statements[statement] = (sql, parameters)
+
+# Called by SQLite every VM_STEP_INTERVAL instructions, counts the work of the route
+
+def count_vm_steps() -> int:
+    route: str = getattr(sql_context, "route", "background")
+    with metrics_lock:
+        vm_step_metrics[route] = vm_step_metrics.get(route, 0) + VM_STEP_INTERVAL
+    return 0
+
+# Add up the execute and fetch time of a statement, log it once past the slow query threshold
+
+class InstrumentedCursor(sqlite3.Cursor):
+    statement: str = ""
+    parameters = ()
+    many: bool = False
+    elapsed: float = 0.0
+    logged: bool = False
+
+    def start(self, sql: str, parameters, many: bool) -> None:
+        self.statement, self.parameters, self.many = sql, parameters, many
+        self.elapsed, self.logged = 0.0, False
+        record_route_statement(sql, (parameters or [None])[0] if many else parameters)
+
+    def record(self, elapsed: float, rows: int = 0, executed: bool = False) -> None:
+        self.elapsed += elapsed
+        record_sql(self.statement, elapsed, rows, executed)
+        if slow_query_threshold is not None and self.elapsed >= slow_query_threshold and not self.logged:
+            self.logged = True
+            log_slow_query(self)
+
+    def execute(self, sql, parameters = ()):
+        self.start(sql, parameters, False)
+        started: float = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.record(time.perf_counter() - started, executed = True)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.start(sql, seq_of_parameters if isinstance(seq_of_parameters, list) else None, True)
+        started: float = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.record(time.perf_counter() - started, executed = True)
+
+    def fetchone(self):
+        started: float = time.perf_counter()
+        row = super().fetchone()
+        self.record(time.perf_counter() - started, row is not None)
+        return row
+
+    def fetchmany(self, size = None):
+        started: float = time.perf_counter()
+        rows: list = super().fetchmany(size or self.arraysize)
+        self.record(time.perf_counter() - started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started: float = time.perf_counter()
+        rows: list = super().fetchall()
+        self.record(time.perf_counter() - started, len(rows))
+        return rows
+
+    def __next__(self):
+        started: float = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self.record(time.perf_counter() - started)
+            raise
+        self.record(time.perf_counter() - started, 1)
+        return row
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory = InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters = ()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+# Time the serialization of every json response
+
+class TimedJSONProvider(DefaultJSONProvider):
+    def response(self, *args, **kwargs):
+        started: float = time.perf_counter()
+        try:
+            return super().response(*args, **kwargs)
+        finally:
+            record_phase("serialization", time.perf_counter() - started)
+
+if METRICS_ENABLED:
+    app.json = TimedJSONProvider(app)
+
+# Run a unit of write work under the route that queued it, so the writer statements are counted for that route
+
+def attribute_write(work, route: str):
+    def attributed_work(cursor):
+        sql_context.route = route
+        try:
+            return work(cursor)
+        finally:
+            sql_context.route = "background"
+    return attributed_work
+
+@app.before_request
+def start_request_metrics():
+    if METRICS_ENABLED:
+        sql_context.route = request.url_rule.rule if request.url_rule else "unmatched"
+        sql_context.phases = {}
+        sql_context.started = time.perf_counter()
+
+# Registered before the unit of work commit so the commit is part of the measured request
+
+@app.after_request
+def record_request_metrics(response):
+    if not METRICS_ENABLED or getattr(sql_context, "phases", None) is None:
+        return response
+    elapsed: float = time.perf_counter() - sql_context.started
+    phases: dict = sql_context.phases
+    phases["application"] = max(elapsed - sum(phases.values()), 0.0)
+    with metrics_lock:
+        metrics: dict = request_metrics.setdefault(sql_context.route, {"count": 0, "seconds": 0.0, "buckets": [0] * len(METRICS_BUCKETS), "phases": {}, "statuses": {}})
+        metrics["count"] += 1
+        metrics["seconds"] += elapsed
+        for index, bucket in enumerate(METRICS_BUCKETS):
+            metrics["buckets"][index] += elapsed <= bucket
+        for phase, seconds in phases.items():
+            metrics["phases"][phase] = metrics["phases"].get(phase, 0.0) + seconds
+        metrics["statuses"][response.status_code] = metrics["statuses"].get(response.status_code, 0) + 1
+    sql_context.phases = None
+    sql_context.route = "background"
+    return response
+
+# Prometheus text exposition of the collected metrics
+
+def render_metrics() -> str:
+    lines: list = [
+        "# HELP crud_requests_total Requests handled by route and status.",
+        "# TYPE crud_requests_total counter",
+    ]
+    with metrics_lock:
+        for route, metrics in sorted(request_metrics.items()):
+            lines += [f'crud_requests_total{{route="{route}",status="{status}"}} {count}' for status, count in sorted(metrics["statuses"].items())]
+        lines += ["# HELP crud_request_duration_seconds Request duration by route.", "# TYPE crud_request_duration_seconds histogram"]
+        for route, metrics in sorted(request_metrics.items()):
+            lines += [f'crud_request_duration_seconds_bucket{{route="{route}",le="{bucket}"}} {count}' for bucket, count in zip(METRICS_BUCKETS, metrics["buckets"])]
+            lines += [
+                f'crud_request_duration_seconds_bucket{{route="{route}",le="+Inf"}} {metrics["count"]}',
+                f'crud_request_duration_seconds_sum{{route="{route}"}} {metrics["seconds"]:.6f}',
+                f'crud_request_duration_seconds_count{{route="{route}"}} {metrics["count"]}',
+            ]
+        lines += ["# HELP crud_request_phase_seconds_total Request time by phase: validation of the request, sql reads, waiting on the writer, json serialization and the rest of the application code.", "# TYPE crud_request_phase_seconds_total counter"]
+        for route, metrics in sorted(request_metrics.items()):
+            lines += [f'crud_request_phase_seconds_total{{route="{route}",phase="{phase}"}} {seconds:.6f}' for phase, seconds in sorted(metrics["phases"].items())]
+        lines += ["# HELP crud_sql_statements_total SQL statements executed by route and statement kind.", "# TYPE crud_sql_statements_total counter"]
+        lines += [f'crud_sql_statements_total{{route="{route}",kind="{kind}"}} {metrics[0]}' for (route, kind), metrics in sorted(sql_metrics.items())]
+        lines += ["# HELP crud_sql_seconds_total Time spent executing and fetching SQL statements.", "# TYPE crud_sql_seconds_total counter"]
+        lines += [f'crud_sql_seconds_total{{route="{route}",kind="{kind}"}} {metrics[1]:.6f}' for (route, kind), metrics in sorted(sql_metrics.items())]
+        lines += ["# HELP crud_sql_rows_returned_total Rows fetched from SQL statements.", "# TYPE crud_sql_rows_returned_total counter"]
+        lines += [f'crud_sql_rows_returned_total{{route="{route}",kind="{kind}"}} {metrics[2]}' for (route, kind), metrics in sorted(sql_metrics.items())]
+        lines += ["# HELP crud_sql_vm_steps_total SQLite virtual machine instructions executed, counted in steps of the progress handler interval (VM_STEP_INTERVAL).", "# TYPE crud_sql_vm_steps_total counter"]
+        lines += [f'crud_sql_vm_steps_total{{route="{route}"}} {steps}' for route, steps in sorted(vm_step_metrics.items())]
+    return "\n".join(lines) + "\n"
+
+## Slow query log
+
+# Lists of placeholders collapse so a lookup of 3 names and one of 300 names are the same statement
+
+@lru_cache(maxsize = 1024)
+def normalize_statement(sql: str) -> str:
+    return re.sub(r"\?(\s*,\s*\?)+", "?, ...", " ".join(sql.split()))
+
+# Types of the bound parameters, repeated types are counted instead of listed
+
+def parameter_shape(parameters) -> str:
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{key}: {type(value).__name__}" for key, value in parameters.items()) + "}"
+    shape: list = []
+    for parameter in parameters or ():
+        type_name: str = type(parameter).__name__
+        if shape and shape[-1][0] == type_name:
+            shape[-1][1] += 1
+        else:
+            shape.append([type_name, 1])
+    return "(" + ", ".join(type_name if count == 1 else f"{type_name} x {count}" for type_name, count in shape) + ")"
+
+# Plan of the statement with its own parameters, on a plain cursor so it is not measured itself
+
+def query_plan(conn: sqlite3.Connection, sql: str, parameters) -> list:
+    if not sql.lstrip().upper().startswith(("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")):
+        return []
+    try:
+        return [row[3] for row in sqlite3.Connection.cursor(conn).execute(f"EXPLAIN QUERY PLAN {sql}", parameters or ()).fetchall()]
+    except sqlite3.Error as error:
+        return [f"unavailable: {error}"]
+
+# A plan line that reads a whole user table (or its alias in the statement) without an index
+
+def full_table_scan(detail: str, sql: str) -> bool:
+    scan = re.fullmatch(r"SCAN (\w+)", detail)
+    if not scan:
+        return False
+    names: set = {name for name in table_schemes if not name.startswith("sqlite_")}
+    names.update(alias for table, alias in re.findall(r"\b(?:FROM|JOIN)\s+(\w+)\s+(?:AS\s+)?(\w+)", sql, re.IGNORECASE) if table in names)
+    return scan.group(1) in names
+
+# Write the statement to the rotating log and keep its totals for the admin report
+
+def log_slow_query(cursor: InstrumentedCursor) -> None:
+    if not slow_query_log.handlers:
+        slow_query_log.addHandler(RotatingFileHandler(SLOW_QUERY_LOG, maxBytes = SLOW_QUERY_LOG_BYTES, backupCount = SLOW_QUERY_LOG_FILES))
+        slow_query_log.propagate = False
+    parameters = (cursor.parameters or [None])[0] if cursor.many else cursor.parameters
+    shape: str = parameter_shape(parameters)
+    if cursor.many:
+        shape = f"{len(cursor.parameters) if cursor.parameters is not None else 'many'} x {shape}"
+    plan: list = query_plan(cursor.connection, cursor.statement, parameters) if parameters is not None else []
+    entry: dict = {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "route": getattr(sql_context, "route", "background"),
+        "statement": normalize_statement(cursor.statement),
+        "parameters": shape,
+        "ms": round(cursor.elapsed * 1000, 3),
+        "plan": plan,
+    }
+    slow_query_log.warning(dumps(entry))
+    with metrics_lock:
+        totals: dict = slow_queries.setdefault(entry["statement"], {"statement": entry["statement"], "count": 0, "total ms": 0.0, "max ms": 0.0, "routes": []})
+        totals["count"] += 1
+        totals["total ms"] = round(totals["total ms"] + entry["ms"], 3)
+        if entry["ms"] >= totals["max ms"]:
+            totals.update({"max ms": entry["ms"], "parameters": entry["parameters"], "plan": entry["plan"]})
+        if entry["route"] not in totals["routes"]:
+            totals["routes"].append(entry["route"])
+
+## Connection pool
+
+# Pragmas of the configured storage profile
+
+def connection_pragmas() -> dict:
+    profile: str = app.config.get("STORAGE_PROFILE", STORAGE_PROFILE)
+    if profile not in storage_profiles:
+        raise ValueError(f"Unknown storage profile {profile!r}, use one of {', '.join(storage_profiles)}")
+    return storage_profiles[profile]
+
+# Apply the storage profile to a connection, the journal mode is left to the read-write connections
+
+def apply_pragmas(conn, read_only: bool = False) -> None:
+    for pragma, value in connection_pragmas().items():
+        if not (read_only and pragma == "journal_mode"):
+            conn.execute(f"PRAGMA {pragma} = {value}")
+
+# Open a connection in autocommit mode, read-only ones through a mode=ro URI
+
+def open_connection(database: str = None, read_only: bool = False) -> sqlite3.Connection:
+    database = database or DATABASE
+    if read_only:
+        database = f"file:{quote(os.path.abspath(database))}?mode=ro"
+    conn = sqlite3.connect(database, uri = read_only, isolation_level = None, check_same_thread = False, factory = InstrumentedConnection if METRICS_ENABLED else sqlite3.Connection)
+    apply_pragmas(conn, read_only)
+    if METRICS_ENABLED:
+        conn.set_progress_handler(count_vm_steps, VM_STEP_INTERVAL)
+    return conn
+
+# Take a pooled read-only connection for the database or open a new one, the writer connection is never pooled
+
+def acquire_connection(database: str = None) -> tuple:
+    pool = connection_pools.setdefault(database or DATABASE, queue.LifoQueue(maxsize = POOL_SIZE))
+    try:
+        return pool.get_nowait(), pool
+    except queue.Empty:
+        return open_connection(database, read_only = True), pool
+
+# Roll back anything left open and hand the connection back to its pool
+
+def release_connection(conn: sqlite3.Connection, pool: queue.LifoQueue) -> None:
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+# Request connection, read-only and one snapshot per request, writes go through the write scheduler
+
+def get_db() -> sqlite3.Connection:
+    if "db" not in g:
+        g.db, g.db_pool = acquire_connection()
+        g.db.execute("BEGIN")
+    return g.db
+
+# Commit the unit of work before the response is sent
+
+@app.after_request
+def commit_unit_of_work(response):
+    if "db" in g and g.db.in_transaction:
+        try:
+            g.db.commit()
+        except sqlite3.Error:
+            g.db.rollback()
+            return jsonify({"error": "Transaction failed, please try again"}), 503
+    return response
+
+# Release the request connection once the request is done
+
+@app.teardown_request
+def release_unit_of_work(exception = None):
+    conn = g.pop("db", None)
+    if conn is not None:
+        release_connection(conn, g.pop("db_pool"))
+
+## Write scheduler
+
+# Start the single writer thread on first use, with the data version it watches taken first
+
+def start_write_scheduler() -> None:
+    with write_lock:
+        if write_threads and write_threads[0].is_alive():
+            return
+        try:
+            check_external_writes(DATABASE)
+        except sqlite3.Error:
+            pass
+        thread = threading.Thread(target = run_write_scheduler, name = "write-scheduler", daemon = True)
+        thread.start()
+        write_threads[:] = [thread]
+
+# Queue a unit of write work on the given tables and wait for its result, cancelled if still queued after WRITE_TIMEOUT
+
+def submit_write(work, tables: tuple = ()) -> tuple:
+    start_write_scheduler()
+    future: Future = Future()
+    if METRICS_ENABLED:
+        work = attribute_write(work, getattr(sql_context, "route", "background"))
+    started: float = time.perf_counter()
+    write_queue.put((DATABASE, work, future, tables))
+    try:
+        try:
+            return future.result(timeout = WRITE_TIMEOUT), None
+        except FutureTimeoutError:
+            if future.cancel():
+                return None, {"error": "Transaction failed, please try again", "detail": "Timed out waiting for the writer"}
+            return future.result(), None
+    except sqlite3.Error as error:
+        return None, {"error": "Transaction failed, please try again", "detail": str(error)}
+    finally:
+        record_phase("write", time.perf_counter() - started)
+
+# Queue statements executed with executemany, the result is the row count of each statement
+
+def write_statements(tables: tuple, *statements: tuple) -> tuple:
+    return submit_write(lambda cursor: [cursor.executemany(sql, params).rowcount for sql, params in statements], tables)
+
+# Take the next write and whatever else arrives within the batch window
+
+def collect_write_batch() -> list:
+    try:
+        batch: list = [write_queue.get(timeout = DATA_VERSION_INTERVAL)]
+    except queue.Empty:
+        return []
+    deadline: float = time.monotonic() + WRITE_BATCH_WAIT
+    while len(batch) < WRITE_BATCH_SIZE:
+        timeout: float = deadline - time.monotonic()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(write_queue.get(timeout = timeout))
+        except queue.Empty:
+            break
+    return batch
+
+# Writer connection of the database, opened on first use
+
+def writer_connection(database: str) -> sqlite3.Connection:
+    if database not in writer_connections:
+        writer_connections[database] = open_connection(database)
+    return writer_connections[database]
+
+# Reload the schemes and drop the cached views when another process committed to the database
+
+def check_external_writes(database: str) -> None:
+    conn = writer_connection(database)
+    data_version: int = conn.execute("PRAGMA data_version").fetchone()[0]
+    if data_versions.setdefault(database, data_version) == data_version:
+        return
+    data_versions[database] = data_version
+    if database == DATABASE:
+        load_table_schemes(conn.cursor())
+        bump_table_versions(set(table_columns))
+
+# Run a batch in one transaction, each write in its own savepoint so a failure only fails its caller
+
+def run_write_batch(database: str, items: list) -> None:
+    items = [item for item in items if item[1].set_running_or_notify_cancel()]
+    if not items:
+        return
+    conn = None
+    results: list = []
+    try:
+        check_external_writes(database)
+        conn = writer_connection(database)
+        conn.execute("BEGIN IMMEDIATE")
+        for work, future, tables in items:
+            conn.execute("SAVEPOINT write_item")
+            try:
+                results.append((future, work(conn.cursor()), None, tables))
+            except Exception as error:
+                conn.execute("ROLLBACK TO write_item")
+                results.append((future, None, error, tables))
+            conn.execute("RELEASE write_item")
+        conn.execute("COMMIT")
+    except Exception as error:
+        if conn is not None and conn.in_transaction:
+            conn.rollback()
+        for _, future, _ in items:
+            future.set_exception(error)
+        return
+
+    bump_table_versions({table for _, _, error, tables in results if not error for table in tables})
+    for future, result, error, _ in results:
+        if error:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+# Writer loop, batches are grouped per database file and outside commits are checked while idle
+
+def run_write_scheduler() -> None:
+    while True:
+        batches: dict = {}
+        batch: list = collect_write_batch()
+        if not batch:
+            try:
+                check_external_writes(DATABASE)
+            except Exception:
+                pass
+            continue
+        for database, work, future, tables in batch:
+            batches.setdefault(database, []).append((work, future, tables))
+        for database, items in batches.items():
+            try:
+                run_write_batch(database, items)
+            except Exception as error:
+                for _, future, _ in items:
+                    if not future.done():
+                        future.set_exception(error)
 
 #########################################################################
 #########################################################################
@@ -35,6 +772,7 @@ def init_db():
 
 # Verify user information
 
+@validation_phase
 def verify_user(json, admin_required = False) -> str | dict:
     if not 'user' in json:
         return {"error": "User required"}
@@ -49,12 +787,14 @@ def verify_user(json, admin_required = False) -> str | dict:
 
 # Verify json_data validity
 
+@validation_phase
 def verify_json_str_values(json_dict: dict, key: str):
     try:
         json_dict[key] = str(json_dict[key].lower())
     except Exception: 
         return ({"error": f"{key.capitalize()} must be a string", key: json_dict[key]})
     
+@validation_phase
 def verify_json_int_values(json_dict: dict, key: str):
     try:
         json_dict[key] = int(json_dict[key])
@@ -62,12 +802,13 @@ def verify_json_int_values(json_dict: dict, key: str):
     except Exception: 
         return ({"error": f"{key.capitalize()} must be an integer and strictly positive", key: json_dict[key]})
 
+@validation_phase
 def verify_json_data(json_list: list, mandatory_keys: list, **other_keys: list) -> None | list:
     for json_dict in json_list:
         for key in mandatory_keys:
             if key in json_dict:
                 continue
-            return ({"error": f"{key.capitalize()} required", key: json_dict[key]})
+            return ({"error": f"{key.capitalize()} required"})
         
         if "semi_mandatory_keys" in other_keys:
             for index, key in enumerate(other_keys["semi_mandatory_keys"]):
@@ -76,7 +817,7 @@ def verify_json_data(json_list: list, mandatory_keys: list, **other_keys: list)
                 if index < len(other_keys["semi_mandatory_keys"]) - 1:
                     continue
                 semi_mandatory_keys = [*other_keys["semi_mandatory_keys"]]
-                return ({"error": f"{' and '.join(semi_mandatory_keys).capitalize()} required", key: json_dict[key]})
+                return ({"error": f"{' and '.join(semi_mandatory_keys).capitalize()} required"})
         
         if 'str_keys' in other_keys:
             for key in other_keys['str_keys']:
@@ -94,9 +835,7 @@ def verify_json_data(json_list: list, mandatory_keys: list, **other_keys: list)
 
 # Verify potential name and new name conflict
 
-def identical_names(json_data, original_i, original_dict, duplicate_i, duplicate_dict) -> None | dict:
-    if original_dict["name"] != duplicate_dict["name"]:
-        return None
+def identical_names(original_dict, duplicate_dict) -> None | dict:
     if "new name" in original_dict:
         if "new name" in duplicate_dict and original_dict["new name"] != duplicate_dict["new name"]:
             return {"error": "Duplicate name, please resolve conflict"}, original_dict, duplicate_dict
@@ -107,37 +846,41 @@ def identical_names(json_data, original_i, original_dict, duplicate_i, duplicate
             original_dict["new quantity"] += duplicate_dict["new quantity"]
         except Exception:
             original_dict["new quantity"] = duplicate_dict["new quantity"]
-    del json_data[original_i + duplicate_i + 1]
 
 def identical_new_names(original_dict, duplicate_dict) -> None | dict:
-    if "new name" not in duplicate_dict:
-        return None
-    if original_dict["new name"] != duplicate_dict["new name"]:
-        return None
     if original_dict["name"] == duplicate_dict["name"]:
         return None
     return {"error": "New name duplicate found"}, original_dict, duplicate_dict
 
 def name_vs_new_name(original_dict, duplicate_dict) -> None | dict:
-    if original_dict["new name"] != duplicate_dict["name"]:
-        return None
     if original_dict["name"] == duplicate_dict["name"]:
         return None
     return {"error": "New name cannot match a product's name"}, original_dict, duplicate_dict
 
+# Merge entries sharing a name, then check new names against each other and against the names, one pass each over dict indexes
+
+@validation_phase
 def verify_potential_name_conflicts(json_data):
-    for original_i, original_dict in enumerate(json_data):
-        for duplicate_i, duplicate_dict in enumerate(json_data[original_i + 1:]):
-            if error := identical_names(json_data, original_i, original_dict, duplicate_i, duplicate_dict):
-                return error
-            if "new name" in original_dict and (error := identical_new_names(original_dict, duplicate_dict)):
-                return error
-        for duplicate_dict in json_data:
-            if "new name" in original_dict and (error := name_vs_new_name(original_dict, duplicate_dict)):
-                return error
+    by_name: dict = {}
+    for json_dict in json_data:
+        original_dict = by_name.setdefault(json_dict["name"], json_dict)
+        if original_dict is not json_dict and (error := identical_names(original_dict, json_dict)):
+            return error
+    json_data[:] = by_name.values()
+
+    by_new_name: dict = {}
+    for json_dict in json_data:
+        if "new name" not in json_dict:
+            continue
+        original_dict = by_new_name.setdefault(json_dict["new name"], json_dict)
+        if original_dict is not json_dict and (error := identical_new_names(original_dict, json_dict)):
+            return error
+        if json_dict["new name"] in by_name and (error := name_vs_new_name(json_dict, by_name[json_dict["new name"]])):
+            return error
 
 # Verify value types for the view request
 
+@validation_phase
 def verify_value_types_and_adjust(filter_data, key, column_type):
     if "TEXT" in column_type:
         if error := verify_json_str_values(filter_data, key):
@@ -157,383 +900,778 @@ def duplicates_from_sql(dict_list: list, *json_dict_keys: str, table: str):
         acc_list += current
 
     json_tuple_product_names: tuple = tuple(acc_list) 
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        return cursor.execute("SELECT * FROM {0} WHERE name IN ({1})".format(table, ', '.join('?' for _ in json_tuple_product_names)), json_tuple_product_names).fetchall()
+    cursor = get_db().cursor()
+    return cursor.execute("SELECT * FROM {0} WHERE name IN ({1})".format(table, ', '.join('?' for _ in json_tuple_product_names)), json_tuple_product_names).fetchall()
 
 # Retrieve user id
 
 def user_info(client_name: str) -> tuple:
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        result = cursor.execute("SELECT * FROM clients WHERE name = ?", (client_name,)).fetchone()
+    cursor = get_db().cursor()
+    result = cursor.execute("SELECT * FROM clients WHERE name = ?", (client_name,)).fetchone()
     if not result: 
         return {"error": "User not found"}
     return result
 
 ## Delete
 
-# Delete duplicates in the same list
+# Delete duplicates in the same list, the first entry of each name keeps the sum of the adjusted keys
 
 def delete_name_duplicates_in_list(dict_list: list, key_to_match: str, *keys_to_adjust: list) -> None:
-    for original_i, original_dict in enumerate(dict_list):
-        duplicate_i = original_i + 1
-        while duplicate_i < len(dict_list):
-            if original_dict[key_to_match] != dict_list[duplicate_i][key_to_match]:
-                duplicate_i += 1
+    by_key: dict = {}
+    for json_dict in dict_list:
+        original_dict = by_key.setdefault(json_dict[key_to_match], json_dict)
+        if original_dict is json_dict:
+            continue
+        for key in keys_to_adjust:
+            if key not in json_dict:
                 continue
-            for key in keys_to_adjust:
-                if key not in dict_list[duplicate_i]:
-                    continue
-                try:
-                    original_dict[key] += dict_list[duplicate_i][key]
-                except Exception:
-                    original_dict[key] = dict_list[duplicate_i][key]
-            del dict_list[duplicate_i]
+            try:
+                original_dict[key] += json_dict[key]
+            except Exception:
+                original_dict[key] = json_dict[key]
+    dict_list[:] = by_key.values()
 
-# Delete matching values between two lists
+# Delete matching values between two lists, matches move to the returned list annotated with the sql id and quantity
 
 def delete_multiple_lists_comparison(dict_list: list, sql_list: list, key_to_match: str) -> list:
+    by_key: dict = {}
+    for json_dict in dict_list:
+        if key_to_match in json_dict:
+            by_key.setdefault(json_dict[key_to_match], json_dict)
+
     json_list_duplicates: list = []
     for sql_tuple in sql_list:
-        for index, json_dict in enumerate(dict_list):
-            if key_to_match not in json_dict or sql_tuple[1] != json_dict[key_to_match]:
-                continue
-            json_dict["id"] = sql_tuple[0]
-            if len(sql_tuple) > 2:
-                json_dict["quantity"] = sql_tuple[2]
-            json_list_duplicates.append(json_dict)
-            del dict_list[index]
-            break
-    return json_list_duplicates
-
-## Conversion
-
-# Accumulator
-
-def accumulator_for_buy_return(transaction_list: list, type_of_transaction: str) -> int:
-    acc: int = 0
-    for sql_tuple in transaction_list:
-        if type_of_transaction in sql_tuple[1]:
-            acc += sql_tuple[0]
-    return acc
-
-# To json
-
-def display_in_json(result_list: list, table: str, descending: bool = False, error: dict = None) -> list:
-    list_to_display: list = []
-    for result_el in reversed(result_list) if descending else result_list:
-        if "search" in result_el:
-            list_to_display.append(result_el)
+        json_dict = by_key.pop(sql_tuple[1], None)
+        if json_dict is None:
             continue
-        new_dict: dict = {name[0]: result_el[index] for index, name in enumerate(table_schemes[table])}
-        list_to_display.append(new_dict)
-    return error + list_to_display if error else list_to_display
+        json_dict["id"] = sql_tuple[0]
+        if len(sql_tuple) > 2:
+            json_dict["quantity"] = sql_tuple[2]
+        json_list_duplicates.append(json_dict)
+
+    matched_dicts: set = {id(json_dict) for json_dict in json_list_duplicates}
+    dict_list[:] = [json_dict for json_dict in dict_list if id(json_dict) not in matched_dicts]
+    return json_list_duplicates
 
-# Tuple int to str
+## Stock reservation
 
-def convert_tuple_int_to_string(sql_results: list, column_nr: int = 0) -> list:
-    new_sql_results: list = []
-    for sql_tuple in sql_results:
-        new_tuple = tuple(str(el) if i == column_nr else el for i, el in enumerate(sql_tuple))
-        new_sql_results.append(new_tuple)
-    return new_sql_results
+# Keep the bought/returned totals of a client and product in step with the ledger
 
-## Binary
+def update_purchase_balance(cursor, client_id: int, product_id: int, type_of_transaction: str, amount: int) -> None:
+    bought, returned = (amount, 0) if type_of_transaction == 'buy' else (0, amount)
+    cursor.execute("INSERT INTO purchase_balances (client_id, product_id, bought, returned) VALUES (?, ?, ?, ?) ON CONFLICT (client_id, product_id) DO UPDATE SET bought = bought + excluded.bought, returned = returned + excluded.returned", (client_id, product_id, bought, returned))
 
-# B-sort
+# Recompute every balance from the buy and return rows of the ledger and its archives
 
-def b_sort_sql_results(sql_results: list, column_nr: int = 0) -> list:
-    left: list = [el for el in sql_results[:int(len(sql_results) / 2)]]
-    right: list = [el for el in sql_results[int(len(sql_results) / 2):]]
-    if len(left) > 1: left = b_sort_sql_results(left, column_nr)
-    if len(right) > 1: right = b_sort_sql_results(right, column_nr)
+def rebuild_purchase_balances(cursor) -> int:
+    cursor.execute("DELETE FROM purchase_balances")
+    return cursor.execute(f"INSERT INTO purchase_balances (client_id, product_id, bought, returned) SELECT client_id, product_id, SUM(CASE type_of_transaction WHEN 'buy' THEN quantity ELSE 0 END), SUM(CASE type_of_transaction WHEN 'return' THEN quantity ELSE 0 END) FROM ({ledger_sql(cursor, 'client_id, product_id, quantity, type_of_transaction')}) WHERE type_of_transaction IN ('buy', 'return') GROUP BY client_id, product_id").rowcount
 
-    li: int = 0
-    ri: int = 0
-    sorted_list: list = []
+# Apply each buy/return as a conditional relative update so concurrent clients never overwrite each other,
+# a buy needs enough stock and a return needs enough bought units, the transaction row and balance are only written for applied lines
 
-    while li < len(left) and ri < len(right):
-        if left[li][column_nr] < right[ri][column_nr]:
-            sorted_list.append(left[li])
-            li += 1
-        elif left[li][column_nr] > right[ri][column_nr]:
-            sorted_list.append(right[ri])
-            ri += 1
+def reserve_stock(cursor, lines: list, client_id: int, user: str) -> list:
+    outcome: list = []
+    for json_dict, type_of_transaction in lines:
+        amount: int = json_dict[type_of_transaction]
+        if type_of_transaction == 'buy':
+            row = cursor.execute("UPDATE products SET quantity = quantity - ? WHERE id = ? AND quantity >= ? RETURNING quantity", (amount, json_dict['id'], amount)).fetchone()
+            rejection: str = "Not enough in stock to complete transaction"
         else:
-            sorted_list.append(left[li])
-            sorted_list.append(right[ri])
-            li += 1
-            ri += 1
-    
-    while li < len(left) or ri < len(right):
-        if li < len(left):
-            sorted_list.append(left[li])
-            li += 1
-        elif ri < len(right):
-            sorted_list.append(right[ri])
-            ri += 1
+            row = cursor.execute("UPDATE products SET quantity = quantity + ? WHERE id = ? AND ? <= (SELECT bought - returned FROM purchase_balances WHERE client_id = ? AND product_id = ?) RETURNING quantity", (amount, json_dict['id'], amount, client_id, json_dict['id'])).fetchone()
+            rejection: str = "Return amount too high"
+        if row is None:
+            outcome.append((None, rejection))
+            continue
+        update_purchase_balance(cursor, client_id, json_dict['id'], type_of_transaction, amount)
+        cursor.execute("INSERT INTO transactions (product_id, product_name, quantity, client_id, client_name, type_of_transaction) VALUES (?, ?, ?, ?, ?, ?)", (json_dict['id'], json_dict['name'], amount, client_id, user, type_of_transaction))
+        outcome.append((row[0], None))
+    return outcome
 
-    return sorted_list
+## Archive
 
-# Search additional matching values after B-search
+# Yearly archive tables of the ledger, oldest first
 
-def search_additional_matching_values(mid: int, sql_results: list, data, column_nr: int = 0) -> int:
-    left = mid - 1
-    right = mid + 1
+def archive_tables(cursor) -> list:
+    return [row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'transactions\\_archive\\_%' ESCAPE '\\' ORDER BY name").fetchall()]
 
-    while left >= 0 and data == sql_results[left][column_nr]: 
-        left -= 1
-    left += 1
+# Select the columns from the ledger and every archive as one result
 
-    while right < len(sql_results) and data == sql_results[right][column_nr]: 
-        right += 1
-    right -= 1
+def ledger_sql(cursor, columns: str) -> str:
+    return " UNION ALL ".join(f"SELECT {columns} FROM {table}" for table in ["transactions", *archive_tables(cursor)])
 
-    return left, right
+# Move the transactions older than the given days into the archive of their year, the highest id stays
 
-# B-search
+def archive_transactions(cursor, days: int) -> tuple:
+    cutoff, cutoff_time = cursor.execute("SELECT date('now', ?), CAST(strftime('%s', date('now', ?)) AS INTEGER)", (f"-{days} days", f"-{days} days")).fetchone()
+    last_id: int = cursor.execute("SELECT COALESCE(MAX(transaction_id), 0) FROM transactions").fetchone()[0]
+    periods: list = [row[0] for row in cursor.execute("SELECT DISTINCT strftime('%Y', transaction_time, 'unixepoch') FROM transactions WHERE transaction_time < ? AND transaction_id < ?", (cutoff_time, last_id)).fetchall() if row[0]]
+    archived: list = []
+    for period in periods:
+        archive_table: str = f"transactions_archive_{period}"
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {archive_table} ({transactions_columns})")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {archive_table}_client ON {archive_table} (client_id)")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {archive_table}_time ON {archive_table} (transaction_time)")
+        period_sql: str = "transaction_time < ? AND transaction_id < ? AND transaction_time >= CAST(strftime('%s', ? || '-01-01') AS INTEGER) AND transaction_time < CAST(strftime('%s', ? || '-01-01', '+1 year') AS INTEGER)"
+        row_count: int = cursor.execute(f"INSERT INTO {archive_table} SELECT * FROM transactions WHERE {period_sql}", (cutoff_time, last_id, period, period)).rowcount
+        cursor.execute(f"DELETE FROM transactions WHERE {period_sql}", (cutoff_time, last_id, period, period))
+        archived.append({"period": period, "archived": row_count})
+    return cutoff, archived
 
-def b_search_sql_results(list: list, data, column_nr: int = 0) -> int:
-    left = 0
-    right = len(list) - 1
+## Compact ledger
 
-    while right >= left:
-        mid = int((left + right) / 2)
-        if data == list[mid][column_nr]:
-            return mid
-        if data > list[mid][column_nr]:
-            left = mid + 1
-        if data < list[mid][column_nr]:
-            right = mid - 1
-    return mid
+# The ledger is a table on the text layout and a view over transaction_rows on the compact one
 
-## View filters
+def ledger_layout(cursor) -> str:
+    ledger_type = cursor.execute("SELECT type FROM sqlite_master WHERE name = 'transactions'").fetchone()
+    return "compact" if ledger_type and ledger_type[0] == "view" else "text"
 
-# = Equal / <= Greater / >= Less
+# Layout, rows and bytes per row of the ledger, no bytes without dbstat
 
-def filter_comparison(sql_results: list, data, column_nr = 0, key = "==" or "<=" or ">=") -> list:
-    filtered_list: list = []
-    if len(sql_results) == 1: 
-        data == sql_results[0][column_nr] and filtered_list.append(sql_results[0])
-        return filtered_list
-    
-    f_range: range = range(0)
-    mid = b_search_sql_results(sql_results, data, column_nr)
-    left, right = search_additional_matching_values(mid, sql_results, data, column_nr)
-    
-    match key:
-        case "==":
-            if data != sql_results[mid][column_nr]:
-                return None
-            f_range = range(left, right + 1)
-        case "<=":
-            f_range = range(left, len(sql_results)) if data <= sql_results[left][column_nr] else range(left + 1, len(sql_results))
-        case ">=":
-            f_range = range(0, right + 1) if data >= sql_results[right][column_nr] else range(0, right)
-    
-    filtered_list = [sql_results[index] for index in f_range]
-    return filtered_list
-
-# -- In between
-
-def filter_in_between(sql_results: list, data, second_data, column_nr = 0) -> list:
-    filtered_list: list = []
-    rev_check: bool = True if second_data < data else False
-    if rev_check: data, second_data = second_data, data
+def ledger_storage(cursor) -> dict:
+    layout: str = ledger_layout(cursor)
+    tables: tuple = ("transaction_rows", "ledger_names", "transaction_types") if layout == "compact" else ("transactions",)
+    row_count: int = cursor.execute(f"SELECT COUNT(*) FROM {tables[0]}").fetchone()[0]
+    try:
+        table_bytes, index_bytes = cursor.execute(f"SELECT COALESCE(SUM(CASE WHEN name IN ({', '.join('?' for _ in tables)}) THEN pgsize END), 0), COALESCE(SUM(CASE WHEN name NOT IN ({', '.join('?' for _ in tables)}) THEN pgsize END), 0) FROM dbstat WHERE name IN (SELECT name FROM sqlite_master WHERE tbl_name IN ({', '.join('?' for _ in tables)}))", tables * 3).fetchone()
+    except sqlite3.OperationalError:
+        return {"layout": layout, "rows": row_count, "bytes per row": None}
+    return {"layout": layout, "rows": row_count, "table bytes": table_bytes, "index bytes": index_bytes, "bytes per row": round((table_bytes + index_bytes) / row_count, 1) if row_count else None}
 
-    mid = b_search_sql_results(sql_results, data, column_nr)
-    left, _ = search_additional_matching_values(mid, sql_results, data, column_nr)
-    if data > sql_results[left][column_nr]:
-        left += 1
+# Copy the next chunk of text rows after the given id into the compact tables, None once every row is copied
 
-    mid = b_search_sql_results(sql_results, second_data, column_nr)
-    _, right = search_additional_matching_values(mid, sql_results, second_data, column_nr)
-    if data >= sql_results[right][column_nr]:
-        right += 1
+def copy_ledger_chunk(cursor, after_id: int, chunk_size: int) -> int:
+    last_id = cursor.execute("SELECT MAX(transaction_id) FROM (SELECT transaction_id FROM transactions WHERE transaction_id > ? ORDER BY transaction_id LIMIT ?)", (after_id, chunk_size)).fetchone()[0]
+    if last_id is None:
+        return None
+    cursor.execute("INSERT OR IGNORE INTO ledger_names (name) SELECT product_name FROM transactions WHERE transaction_id > ? AND transaction_id <= ? UNION SELECT client_name FROM transactions WHERE transaction_id > ? AND transaction_id <= ?", (after_id, last_id, after_id, last_id))
+    cursor.execute("INSERT OR IGNORE INTO transaction_types (name) SELECT DISTINCT type_of_transaction FROM transactions WHERE transaction_id > ? AND transaction_id <= ?", (after_id, last_id))
+    cursor.execute("INSERT OR REPLACE INTO transaction_rows (transaction_id, transaction_time, product_id, product_name_id, quantity, client_id, client_name_id, type) SELECT t.transaction_id, COALESCE(t.transaction_time, CAST(strftime('%s', t.transaction_date) AS INTEGER)), t.product_id, product_names.id, t.quantity, t.client_id, client_names.id, transaction_types.id FROM transactions t LEFT JOIN ledger_names product_names ON product_names.name = t.product_name LEFT JOIN ledger_names client_names ON client_names.name = t.client_name LEFT JOIN transaction_types ON transaction_types.name = t.type_of_transaction WHERE t.transaction_id > ? AND t.transaction_id <= ?", (after_id, last_id))
+    return last_id
+
+# Copy the last rows, then replace the text table with the compact view
+
+def switch_to_compact_ledger(cursor, after_id: int) -> None:
+    while (after_id := copy_ledger_chunk(cursor, after_id, COMPACT_CHUNK_SIZE)) is not None:
+        pass
+    cursor.execute("DELETE FROM transaction_rows WHERE transaction_id NOT IN (SELECT transaction_id FROM transactions)")
+    cursor.execute("DROP TABLE transactions")
+    for statement in compact_ledger_view:
+        cursor.execute(statement)
+    init_indexes(cursor)
+    init_rollups(cursor)
+
+# Run write work in its own transaction on the connection, returns (result, error) like submit_write
+
+def connection_writer(conn):
+    def run_write(work) -> tuple:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = work(conn.cursor())
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result, None
+    return run_write
+
+# Online migration to the compact layout, one write per chunk so the routes keep writing in between
+
+def migrate_to_compact_ledger(run_write) -> tuple:
+    def start(cursor):
+        if ledger_layout(cursor) == "compact":
+            return None
+        cursor.execute("UPDATE transactions SET transaction_time = CAST(strftime('%s', transaction_date) AS INTEGER) WHERE transaction_time IS NULL")
+        for statement in compact_ledger_tables:
+            cursor.execute(statement)
+        return ledger_storage(cursor)
+    before, error = run_write(start)
+    if error or before is None:
+        return None, error or {"error": "Transactions already use the compact layout"}
+
+    after_id: int = 0
+    while after_id is not None:
+        last_id, error = run_write(lambda cursor: copy_ledger_chunk(cursor, after_id, COMPACT_CHUNK_SIZE))
+        if error:
+            return None, error
+        if last_id is None:
+            break
+        after_id = last_id
+    after, error = run_write(lambda cursor: (switch_to_compact_ledger(cursor, after_id), ledger_storage(cursor))[1])
+    if error:
+        return None, error
+    saved = round(before["bytes per row"] - after["bytes per row"], 1) if before["bytes per row"] and after["bytes per row"] else None
+    return {"before": before, "after": after, "bytes per row saved": saved}, None
+
+## Import
+
+# Read rows one at a time from a csv or ndjson request body with their line, a line that is not valid json gives None
+
+def read_import_rows(stream, mimetype: str):
+    text = io.TextIOWrapper(stream, encoding = "utf-8", newline = "")
+    if mimetype == "text/csv":
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_nr, line in enumerate(text, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_nr, loads(line)
+        except ValueError:
+            yield line_nr, None
+
+# Move the staged rows into the table, names already in the database are skipped and names repeated in the file are merged
+
+def move_imported_rows(cursor, table: str, stage_table: str) -> tuple:
+    duplicates: int = cursor.execute(f"SELECT COUNT(DISTINCT name) FROM {stage_table} WHERE name IN (SELECT name FROM {table})").fetchone()[0]
+    if table == "clients":
+        inserted: int = cursor.execute(f"INSERT INTO clients (name) SELECT DISTINCT name FROM {stage_table} WHERE name NOT IN (SELECT name FROM clients)").rowcount
+        return inserted, duplicates
+
+    max_id: int = cursor.execute("SELECT COALESCE(MAX(id), 0) FROM products").fetchone()[0]
+    inserted: int = cursor.execute(f"INSERT INTO products (name, quantity) SELECT name, SUM(quantity) FROM {stage_table} WHERE name NOT IN (SELECT name FROM products) GROUP BY name").rowcount
+    cursor.execute("INSERT INTO transactions (product_id, product_name, quantity, client_id, client_name, type_of_transaction) SELECT id, name, quantity, 0, 'admin', 'add' FROM products WHERE id > ?", (max_id,))
+    return inserted, duplicates
+
+# Validate the streamed rows with the usual str/int rules and stage them in chunks in a temporary table of the writer,
+# the rows then reach the table and the ledger in one transaction
+
+def import_rows(table: str, columns: dict, **validation) -> tuple:
+    stage_table: str = f"import_{uuid.uuid4().hex}"
+    column_names: list = list(columns)
+    insert_sql: str = f"INSERT INTO temp.{stage_table} ({', '.join(column_names)}) VALUES ({', '.join('?' for _ in column_names)})"
+    _, error = submit_write(lambda cursor: cursor.execute(f"CREATE TEMP TABLE {stage_table} ({', '.join(f'{name} {column_type}' for name, column_type in columns.items())})"))
+    if error:
+        return None, error
+
+    summary: dict = {"inserted": 0, "duplicates": 0, "rejected": 0, "rejected rows": []}
+    try:
+        chunk: list = []
+        for line_nr, json_dict in read_import_rows(request.stream, request.mimetype):
+            error = verify_json_data([json_dict], **validation) if isinstance(json_dict, dict) else {"error": "Invalid row"}
+            if error:
+                summary["rejected"] += 1
+                if len(summary["rejected rows"]) < IMPORT_ERRORS_SHOWN:
+                    summary["rejected rows"].append({"line": line_nr, **error})
+                continue
+            chunk.append(tuple(json_dict[name] for name in column_names))
+            if len(chunk) == IMPORT_CHUNK_SIZE:
+                _, error = write_statements((), (insert_sql, chunk))
+                if error:
+                    return None, error
+                chunk = []
+
+        if chunk:
+            _, error = write_statements((), (insert_sql, chunk))
+            if error:
+                return None, error
+        counts, error = submit_write(lambda cursor: move_imported_rows(cursor, table, f"temp.{stage_table}"), (table, "transactions"))
+        if error:
+            return None, error
+        summary["inserted"], summary["duplicates"] = counts
+        return summary, None
+    finally:
+        submit_write(lambda cursor: cursor.execute(f"DROP TABLE IF EXISTS temp.{stage_table}"))
 
-    filtered_list = [sql_results[index] for index in range(left, right)]
-    return filtered_list
+## Conversion
 
-# ** Contains
+# To json
 
-def filter_contains(sql_results: list, data: str, column_nr = 0) -> list:
-    i: int = 0
-    filtered_list: list = []
-    
-    for el in sql_results:
-        data_i: int = 0
-        sql_i: int = 0
-        while data_i < len(data) and sql_i < len(el[column_nr]):
-            if data[data_i] == el[column_nr][sql_i]:
-                data_i += 1
-            elif sql_i >= len(el[column_nr]) - len(data):
-                break
-            else:
-                data_i = 0
-            sql_i += 1
-        if data_i == len(data):
-            filtered_list.append(sql_results[i])
-        i += 1
-    
-    return filtered_list
+def display_in_json(result_list: list, table: str, error: list = None) -> list:
+    column_names: list = table_columns[table]
+    list_to_display: list = []
+    for result_el in result_list:
+        if isinstance(result_el, dict):
+            list_to_display.append(result_el)
+            continue
+        list_to_display.append(dict(zip(column_names, result_el)))
+    return error + list_to_display if error else list_to_display
 
-# *a Starts with / a* Ends with
+# Display the result as column names and row values, search markers start a new group of rows
 
-def filter_start_end(sql_results: list, data: str, column_nr = 0, key = "*a" or "a*") -> list:
-    i: int = 0
-    filtered_list: list = []
+def display_columnar(result_list: list, table: str, error: list = None) -> dict:
+    columnar: dict = {"columns": table_columns[table], "rows": []}
+    rows: list = columnar["rows"]
+    for result_el in result_list:
+        if isinstance(result_el, dict):
+            columnar.setdefault("groups", []).append({**result_el, "rows": []})
+            rows = columnar["groups"][-1]["rows"]
+            continue
+        rows.append(result_el)
+    if "groups" in columnar:
+        del columnar["rows"]
+    if error:
+        columnar["errors"] = error
+    return columnar
+
+## Query compiler
+
+# Operators and the condition they compile to, <= Greater / >= Less like the original filters
+
+sql_operators: dict = {
+    "==": "{0} = ?",
+    "<=": "{0} >= ?",
+    ">=": "{0} <= ?",
+    "--": "{0} BETWEEN ? AND ?",
+    "**": "{0} LIKE ? ESCAPE '\\'",
+    "*a": "{0} LIKE ? ESCAPE '\\'",
+    "a*": "{0} LIKE ? ESCAPE '\\'",
+}
+
+# transaction_date comparisons run as unix time ranges on the indexed transaction_time
+
+time_operators: dict = {
+    "==": '"transaction_time" >= ? AND "transaction_time" < ?',
+    "--": '"transaction_time" >= ? AND "transaction_time" < ?',
+    "<=": '"transaction_time" >= ?',
+    ">=": '"transaction_time" < ?',
+}
+
+# Unix time range of a YYYY-MM-DD date, a whole day, or of a YYYY-MM-DD HH:MM:SS time, one second
+
+time_formats: dict = {
+    r"\d{4}-\d{2}-\d{2}": ("%Y-%m-%d", 86400),
+    r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}": ("%Y-%m-%d %H:%M:%S", 1),
+}
+
+def time_range(value: str) -> tuple:
+    for pattern, (time_format, span) in time_formats.items():
+        if re.fullmatch(pattern, str(value)):
+            start: int = int(datetime.strptime(str(value), time_format).replace(tzinfo = timezone.utc).timestamp())
+            return start, start + span
+    raise ValueError(value)
+
+# Escape a value and wrap it in the LIKE pattern of the operator
+
+def like_pattern(data, operator: str) -> str:
+    data = str(data).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    match operator:
+        case "**":
+            return f"%{data}%"
+        case "*a":
+            return f"{data}%"
+        case "a*":
+            return f"%{data}"
 
-    for el in sql_results:
-        ch_i: int = 0 if "*a" in key else -1
-        counter: int = 0
-        if len(el[column_nr]) >= len(data) and el[column_nr][ch_i] == data[ch_i]:
-            while counter < len(el[column_nr]) and counter < len(data):
-                ch_i = ch_i + 1 if "*a" in key else ch_i - 1
-                counter += 1
-            if counter == len(data):
-                filtered_list.append(el)    
-        i += 1
+# Candidate rows come from the trigram index, the LIKE then keeps the exact starts with / ends with semantics
 
-    return filtered_list
+def fts_condition(table: str, column: str) -> str:
+    return f"\"id\" IN (SELECT rowid FROM {fts_tables[table]} WHERE {fts_tables[table]} MATCH ?) AND {sql_operators['**'].format(column)}"
 
-# Filter Handler
+# Pick the operator and condition of one column
 
-def filter_list(sql_results: list, data: str | int, column_nr: int, operator: str = None, second_data: str | int = None) -> list:
-    if len(sql_results) > 1:
-        sql_results = b_sort_sql_results(sql_results, column_nr)
-    
-    filtered_list: list = []
+def plan_condition(table: str, column_name: str, column_type: str, operator: str, length_class: int) -> tuple:
+    column: str = f'"{column_name}"'
+    time_column: bool = column_name == "transaction_date" and "transaction_time" in table_columns[table]
     if not operator:
-        filtered_list = filter_comparison(sql_results, data, column_nr, "==")
-        if isinstance(sql_results[0][column_nr], str) and len(data) >= 3:
-            data = str(data).lower()
-            if result := filter_start_end(sql_results, data, column_nr, "*a"):
-                filtered_list += result
-        if isinstance(sql_results[0][column_nr], str) and len(data) >= 5:
-            data = str(data).lower()
-            if result := filter_contains(sql_results, data, column_nr):
-                filtered_list += result
-        if not filtered_list:
-            return {"error": "Information not found with the search criteria"}
-        return filtered_list
-
+        operator = "=="
+        if "TEXT" in column_type and length_class >= 1 and not time_column:
+            operator = "*a"
+        if "TEXT" in column_type and length_class == 2 and not time_column:
+            operator = "**"
+
+    if operator not in sql_operators:
+        return operator, None, False
+    if time_column and operator in time_operators:
+        return f"time {operator}", time_operators[operator], False
+    if operator in ("**", "*a", "a*"):
+        if "TEXT" not in column_type:
+            column = f"CAST({column} AS TEXT)"
+        if column_name == "name" and table in fts_tables and length_class >= 1:
+            return operator, fts_condition(table, column), True
+    return operator, sql_operators[operator].format(column), False
+
+# Bind the values of a request to the condition of a plan step
+
+def condition_params(operator: str, data, second_data, fts: bool) -> list:
     match operator:
-        case "==" | ">=" | "<=":
-            filtered_list = filter_comparison(sql_results, data, column_nr, operator)
-        case "**":
-            if isinstance(sql_results[0][column_nr], int):
-                sql_results = convert_tuple_int_to_string(sql_results, column_nr)
-                data = str(data)
-            filtered_list = filter_contains(sql_results, data, column_nr)
-        case "*a" | "a*":
-            if isinstance(sql_results[0][column_nr], int):
-                sql_results = convert_tuple_int_to_string(sql_results, column_nr)
-                data = str(data)
-            filtered_list = filter_start_end(sql_results, data, column_nr, operator)
         case "--":
-            filtered_list = filter_in_between(sql_results, data, second_data, column_nr)
+            if second_data < data:
+                data, second_data = second_data, data
+            return [data, second_data]
+        case "**" | "*a" | "a*":
+            params: list = [like_pattern(data, operator)]
+            if fts:
+                params.insert(0, '"{0}"'.format(str(data).replace('"', '""')))
+            return params
+        case "time ==":
+            return list(time_range(data))
+        case "time --":
+            if second_data < data:
+                data, second_data = second_data, data
+            return [time_range(data)[0], time_range(second_data)[1]]
+        case "time <=":
+            return [time_range(data)[0]]
+        case "time >=":
+            return [time_range(data)[1]]
         case _:
-            return {"error": "Invalid operator"}
-        
-    if not filtered_list:
-        return {"error": "Information not found with the search criteria"}
-    return filtered_list
-
-# Handle request for one or more items in a single dictionary and accumulate all results if needed
-
-def verify_filters(sql_results: list, json_filter: dict, table: str):
-    result: list = sql_results
-    for key in json_filter:
-        for index, table_tuple in enumerate(table_schemes[table]):
-            column_name, column_type = table_tuple
+            return [data]
+
+# Length class of a value: under 3, 3 to 4, 5 and more characters
+
+def text_length_class(data) -> int:
+    if not isinstance(data, str):
+        return 0
+    return 2 if len(data) >= 5 else 1 if len(data) >= 3 else 0
+
+# Split a filter dictionary into its shape, keys / operators / length classes, and its values
+
+def filter_shape(json_filter: dict):
+    if not isinstance(json_filter, dict):
+        return None, {"error": "Filter must be a dictionary", "filter": json_filter}
+    shape: list = []
+    values: list = []
+    for key, value in json_filter.items():
+        data, operator, second_data = value, None, None
+        if isinstance(value, list):
+            if len(value) == 3 and "--" in value:
+                data, second_data, operator = value
+            elif "--" in value:
+                return None, {"error": "The operator requires a second value", key: value[0], "operator": "--"}
+            elif len(value) == 2:
+                data, operator = value
+            elif len(value) == 1:
+                data = value[0]
+            else:
+                return None, {"error": "Innapropriate search format, one value and one operator, except for '--', where two search values of the same type and one operator are required", key: value[0] if value else None, "operator": value[1] if len(value) > 1 else None}
+        if operator is not None and not isinstance(operator, str):
+            return None, {"error": "Invalid operator", key: data, "operator": str(operator)}
+        shape.append((key, operator, text_length_class(data)))
+        values.append((data, second_data))
+    return (tuple(shape), values), None
+
+# Resolve the columns and conditions once per table and filter shape
+
+@lru_cache(maxsize = FILTER_PLAN_CACHE_SIZE)
+def filter_plan(table: str, shape: tuple) -> tuple:
+    steps: list = []
+    for index, (key, operator, length_class) in enumerate(shape):
+        for column_name, column_type in table_schemes[table]:
             if key not in column_name:
                 continue
-
-            filter_data: dict = {}
-            if isinstance(json_filter[key], list):
-                if len(json_filter[key]) == 1:
-                    filter_data[key] = json_filter[key][0]
-                    filter_data['operator'] = None
-                if len(json_filter[key]) == 2:
-                    filter_data[key], filter_data['operator'] = json_filter[key]
-                filter_data['second data'] = None
-                if len(json_filter[key]) == 3 and "--" in json_filter[key]:
-                    filter_data[key], filter_data['second data'], filter_data['operator'] = json_filter[key]
-                    if error := verify_value_types_and_adjust(filter_data, 'second data', column_type):
-                        return None, error
-                elif len(json_filter[key]) != 3 and "--" in json_filter[key]:
-                    return None, {"error": "The operator requires a second value", key: json_filter[key][0], "operator": json_filter[key][1]}
-                elif len(json_filter[key]) > 2:
-                    return None, {"error": "Innapropriate search format, one value and one operator, except for '--', where two search values of the same type and one operator are required", key: json_filter[key][0], "operator": json_filter[key][1]}
-            else:
-                filter_data[key] = json_filter[key]
-                filter_data['second data'] = None
-                filter_data['operator'] = None
-            
-            if error := verify_value_types_and_adjust(filter_data, key, column_type):
-                return None, error
-
-            result = filter_list(result, filter_data[key], index, filter_data['operator'], filter_data['second data'])
-            if "error" in result:
-                filter_data["error"] = result["error"]
-                return None, filter_data
-    return result, None
-
-# Narrow down result based on multiple json dictionary request
-
-def multiple_results(sql_results: list, json_filter_list: list, table: str) -> list:
-    acc_results: list = []
-    acc_error: list = []
-    for index, json_filter in enumerate(json_filter_list):
-        results, error = verify_filters(sql_results, json_filter, table)
-        if results:
-            acc_results += [{"search": index + 1}] + results
-        if error:
-            acc_error.append(error)
-    return acc_results, *acc_error
+            steps.append((index, key, column_type, *plan_condition(table, column_name, column_type, operator, length_class)))
+    return tuple(steps)
+
+# Run a compiled select on a table, the cursor can be iterated without fetching everything
+
+def select_cursor(cursor, table: str, conditions: list = None, params: list = None, order_sql: str = ""):
+    where_sql: str = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    return cursor.execute(f"SELECT * FROM {table}{where_sql}{order_sql}", params or [])
+
+def select_filtered(cursor, table: str, conditions: list = None, params: list = None, order_sql: str = "") -> list:
+    return select_cursor(cursor, table, conditions, params, order_sql).fetchall()
+
+# Check if a table holds at least one row
+
+def table_is_empty(cursor, table: str) -> bool:
+    return cursor.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() is None
+
+# Handle request for one or more items in a single dictionary
+
+@validation_phase
+def verify_filters(json_filter: dict, table: str):
+    parsed, error = filter_shape(json_filter)
+    if error:
+        return None, error
+    shape, values = parsed
+
+    conditions: list = []
+    params: list = []
+    for index, key, column_type, operator, condition, fts in filter_plan(table, shape):
+        data, second_data = values[index]
+        filter_data: dict = {key: data, 'operator': shape[index][1], 'second data': second_data}
+        if filter_data['operator'] == "--" and (error := verify_value_types_and_adjust(filter_data, 'second data', column_type)):
+            return None, error
+        if error := verify_value_types_and_adjust(filter_data, key, column_type):
+            return None, error
+        if condition is None:
+            filter_data["error"] = "Invalid operator"
+            return None, filter_data
+        try:
+            params += condition_params(operator, filter_data[key], filter_data['second data'], fts)
+        except ValueError:
+            filter_data["error"] = "Dates must be YYYY-MM-DD or YYYY-MM-DD HH:MM:SS"
+            return None, filter_data
+        conditions.append(condition)
+    return (conditions, params), None
 
 # Reorder view based on json request
 
-def order_by_column(result_list: list, json_order: dict, table: str) -> list:
-    for index, column_name in enumerate(table_schemes[table]):
-        if json_order["column"] == column_name[0]:
-            column_nr = index
-    return b_sort_sql_results(result_list, column_nr)
-
-# Check if the json is a list of dictionaries or a dictionary
+def order_by_column(json_order: dict, table: str):
+    if not isinstance(json_order, dict):
+        return None, None
+    column_names: list = table_columns[table]
+    column: str = json_order.get("column", column_names[0])
+    if column not in column_names:
+        return None, {"error": "Order column not found", "column": column}
+    return (column, bool(json_order.get("descending"))), None
+
+# Order by the column, with the primary key breaking ties so every row has a stable position
+
+def order_clause(order: tuple, table: str) -> str:
+    if not order:
+        return ""
+    column, descending = order
+    key_column: str = table_columns[table][0]
+    direction: str = " DESC" if descending else ""
+    tie_breaker: str = f', "{key_column}"{direction}' if column != key_column else ""
+    return f' ORDER BY "{column}"{direction}{tie_breaker}'
+
+## Pagination
+
+# The cursor token carries the order and the order value and key of the last row sent
+
+def encode_cursor(order: tuple, sql_tuple: tuple, table: str) -> str:
+    column, descending = order
+    column_nr: int = table_columns[table].index(column)
+    return base64.urlsafe_b64encode(dumps([column, descending, sql_tuple[column_nr], sql_tuple[0]]).encode()).decode()
+
+# Pages filtered on transaction_date follow the transaction_time index, others the primary key
+
+def default_page_order(json_filter, table: str) -> tuple:
+    if isinstance(json_filter, dict) and "transaction_date" in json_filter and "transaction_time" in table_columns[table]:
+        return "transaction_time", False
+    return table_columns[table][0], False
+
+# Verify limit, offset and cursor, a cursor becomes a keyset condition on (order column, key)
+
+def page_request(json: dict, table: str, order: tuple):
+    if "limit" not in json and "cursor" not in json and "offset" not in json:
+        return None, None
+    if isinstance(json.get("filter"), list):
+        return None, {"error": "Pagination requires a single filter"}
+
+    page: dict = {"limit": json.get("limit", DEFAULT_PAGE_SIZE), "offset": json.get("offset", 0), "conditions": [], "params": []}
+    if error := verify_json_int_values(page, "limit") or verify_json_int_values(page, "offset"):
+        return None, error
+    if not 1 <= page["limit"] <= MAX_PAGE_SIZE or page["offset"] < 0:
+        return None, {"error": f"Limit must be between 1 and {MAX_PAGE_SIZE} and offset positive", "limit": page["limit"], "offset": page["offset"]}
+
+    key_column: str = table_columns[table][0]
+    page["order"] = order or default_page_order(json.get("filter"), table)
+    if "cursor" not in json:
+        return page, None
 
-def view_filter(sql_results: list, json: dict, table: str) -> list:
-    json_filter = json["filter"]
-    if isinstance(json_filter, list):
-        json_filter[0]
-        result_list = multiple_results(sql_results, json_filter, table)
+    try:
+        cursor_column, cursor_descending, value, key = loads(base64.urlsafe_b64decode(json["cursor"]))
+    except Exception:
+        return None, {"error": "Invalid cursor", "cursor": json["cursor"]}
+    column, descending = page["order"]
+    if (cursor_column, cursor_descending) != (column, descending):
+        return None, {"error": "Cursor does not match the order", "cursor": json["cursor"]}
+
+    comparison: str = "<" if descending else ">"
+    if column == key_column:
+        page["conditions"], page["params"] = [f'"{key_column}" {comparison} ?'], [key]
     else:
-        result_list = verify_filters(sql_results, json_filter, table)
-    return result_list
+        page["conditions"], page["params"] = [f'("{column}", "{key_column}") {comparison} (?, ?)'], [value, key]
+    page["offset"] = 0
+    return page, None
+
+# Page of results with the token for the next one, None on the last page
+
+def display_page(result_list: list, table: str, page: dict, errors: list) -> dict:
+    if errors:
+        return errors[0]
+    next_cursor: str = encode_cursor(page["order"], result_list[page["limit"] - 1], table) if len(result_list) > page["limit"] else None
+    if page["columnar"]:
+        return {**display_columnar(result_list[:page["limit"]], table), "next cursor": next_cursor}
+    return {"results": display_in_json(result_list[:page["limit"]], table), "next cursor": next_cursor}
+
+# Compile the view request into one select per search, with the order and page applied to each
+
+@validation_phase
+def view_plan(json: dict, table: str, conditions: list = None, params: list = None):
+    conditions = list(conditions or [])
+    params = list(params or [])
+    if json.get("format", "objects") not in ("objects", "columnar", "rows"):
+        return None, {"error": "Invalid format, use objects, columnar or rows", "format": json["format"]}
+    columnar: bool = json.get("format") in ("columnar", "rows")
+    order, error = order_by_column(json.get("order"), table)
+    if error:
+        return None, error
+    page, error = page_request(json, table, order)
+    if error:
+        return None, error
+    if page:
+        page["columnar"] = columnar
+
+    order_sql: str = order_clause(order, table)
+    if page:
+        conditions += page["conditions"]
+        params += page["params"]
+        order_sql = f"{order_clause(page['order'], table)} LIMIT {page['limit'] + 1} OFFSET {page['offset']}"
+
+    json_filter = json.get("filter")
+    if "filter" not in json:
+        searches: list = [(None, {})]
+    elif isinstance(json_filter, list):
+        searches: list = list(enumerate(json_filter, 1))
+    else:
+        searches: list = [(None, json_filter)]
+
+    selects: list = []
+    errors: list = []
+    for search, json_filter in searches:
+        compiled, error = verify_filters(json_filter, table)
+        if error:
+            errors.append(error)
+            continue
+        selects.append((search, json_filter, conditions + compiled[0], params + compiled[1]))
+    return {"selects": selects, "errors": errors, "order_sql": order_sql, "page": page, "filtered": "filter" in json, "columnar": columnar}, None
 
 # Handle json request and sent info to the right function
 
-def view_handler(json: dict, result_list: list, table: str):
-    if "filter" in json:
-        result_list, error = view_filter(result_list, json, table)
-    else:
-        result_list = None
-        error = None
-            
-    if not result_list:
+def view_handler(json: dict, table: str, conditions: list = None, params: list = None):
+    plan, error = view_plan(json, table, conditions, params)
+    if error:
         return error
 
-    if "order" in json:
-        json_order = json["order"]
-        if "column" in json["order"]:
-            result_list = order_by_column(result_list, json_order, table)
+    cursor = get_db().cursor()
+    result_list: list = []
+    errors: list = plan["errors"]
+    for search, json_filter, conditions, params in plan["selects"]:
+        results = select_filtered(cursor, table, conditions, params, plan["order_sql"])
+        if not results and plan["filtered"]:
+            errors.append({"error": "Information not found with the search criteria", **json_filter})
+            continue
+        result_list += ([{"search": search}] if search else []) + results
+
+    if plan["page"]:
+        return display_page(result_list, table, plan["page"], errors)
+    if not result_list:
+        return errors[0] if len(errors) == 1 else errors
+    if plan["columnar"]:
+        return display_columnar(result_list, table, errors)
+    return display_in_json(result_list, table, errors)
+
+## Streaming
+
+# Check if the client asked for newline delimited json
+
+def wants_ndjson() -> bool:
+    return request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"]) == "application/x-ndjson"
+
+# Rows of a cursor fetched STREAM_BATCH_SIZE at a time, so instrumentation records once per batch
+
+def fetch_batches(cursor):
+    while rows := cursor.fetchmany(STREAM_BATCH_SIZE):
+        yield from rows
+
+# Yield one json line per row, on a connection of its own since it outlives the request
+
+def stream_rows(database: str, table: str, plan: dict):
+    conn, pool = acquire_connection(database)
+    column_names: list = table_columns[table]
+    page: dict = plan["page"]
     try:
-        descending = json_order["descending"]
-    except Exception:
-        descending = False
-    
-    return display_in_json(result_list, table, descending, error)
+        for error in plan["errors"]:
+            yield dumps(error) + "\n"
+        if plan["columnar"]:
+            yield dumps({"columns": column_names}) + "\n"
+        conn.execute("BEGIN")
+        for search, json_filter, conditions, params in plan["selects"]:
+            row_count: int = 0
+            last_tuple: tuple = None
+            for sql_tuple in fetch_batches(select_cursor(conn.cursor(), table, conditions, params, plan["order_sql"])):
+                if page and row_count == page["limit"]:
+                    yield dumps({"next cursor": encode_cursor(page["order"], last_tuple, table)}) + "\n"
+                    break
+                if search and not row_count:
+                    yield dumps({"search": search}) + "\n"
+                yield dumps(sql_tuple if plan["columnar"] else dict(zip(column_names, sql_tuple))) + "\n"
+                last_tuple = sql_tuple
+                row_count += 1
+            if not row_count and plan["filtered"]:
+                yield dumps({"error": "Information not found with the search criteria", **json_filter}) + "\n"
+    finally:
+        release_connection(conn, pool)
+
+# Stream the view as ndjson, peak memory stays at one batch of rows whatever the result size
+
+def stream_view(json: dict, table: str, conditions: list = None, params: list = None):
+    plan, error = view_plan(json, table, conditions, params)
+    if error:
+        return jsonify(error), 200
+    return Response(stream_rows(DATABASE, table, plan), mimetype = "application/x-ndjson")
+
+## Response cache
+
+# Bump the version of written tables so their cached views are no longer served
+
+def bump_table_versions(tables: set) -> None:
+    with cache_lock:
+        for table in tables:
+            if not table.startswith("temp."):
+                table_versions[table] = table_versions.get(table, 0) + 1
+
+# Look up a cached view response, or a 304 when the client already holds its ETag
+
+def lookup_cached_view(role: str, json: dict, tables: tuple) -> tuple:
+    start_write_scheduler()
+    canonical_json: str = dumps({key: value for key, value in (json or {}).items() if key != "user"}, sort_keys = True)
+    key: tuple = (DATABASE, request.path, role, canonical_json)
+    with cache_lock:
+        versions: tuple = tuple(table_versions.get(table, 0) for table in tables)
+        etag: str = hashlib.sha1(dumps([etag_epoch, *key, versions]).encode()).hexdigest()
+        variants: tuple = (f"{etag}-gzip", etag) if "gzip" in request.accept_encodings else (etag, f"{etag}-gzip")
+        matched: str = next((variant for variant in variants if request.if_none_match.contains_weak(variant)), None)
+        if matched:
+            response_cache_stats["not modified"] += 1
+            response = Response(status = 304)
+            response.set_etag(matched)
+            response.vary.add("Accept-Encoding")
+            return (key, versions, etag), response
+        entry = response_cache.get(key)
+        if entry and entry[0] == versions:
+            response_cache.move_to_end(key)
+            response_cache_stats["hits"] += 1
+            return (key, versions, etag), view_response(*entry[1:], etag)
+        response_cache_stats["misses"] += 1
+    return (key, versions, etag), None
+
+# Send the body gzip compressed when the client accepts it and it is large enough to be worth it
+
+def view_response(body: bytes, gzip_body: bytes, status: int, etag: str) -> Response:
+    if gzip_body and "gzip" in request.accept_encodings:
+        response = Response(gzip_body, status, mimetype = "application/json")
+        response.headers["Content-Encoding"] = "gzip"
+        response.set_etag(f"{etag}-gzip")
+    else:
+        response = Response(body, status, mimetype = "application/json")
+        response.set_etag(etag)
+    response.vary.add("Accept-Encoding")
+    return response
+
+# Bytes held by a cache entry, its body and gzip body
+
+def cached_bytes(entry: tuple) -> int:
+    return len(entry[1]) + len(entry[2] or b"")
+
+# Empty the response cache
+
+def clear_response_cache() -> None:
+    with cache_lock:
+        response_cache.clear()
+        response_cache_stats["bytes"] = 0
+
+# Serialize and compress the view once and keep it, evicting the least recently used past the budgets
+
+def store_cached_view(cache_entry: tuple, payload, status: int) -> Response:
+    key, versions, etag = cache_entry
+    body: bytes = jsonify(payload).get_data()
+    gzip_body: bytes = gzip.compress(body, compresslevel = 5) if len(body) >= GZIP_MIN_BYTES else None
+    if len(body) <= RESPONSE_CACHE_MAX_BYTES:
+        with cache_lock:
+            if key in response_cache:
+                response_cache_stats["bytes"] -= cached_bytes(response_cache.pop(key))
+            response_cache[key] = (versions, body, gzip_body, status)
+            response_cache_stats["bytes"] += cached_bytes(response_cache[key])
+            while len(response_cache) > RESPONSE_CACHE_SIZE or response_cache_stats["bytes"] > RESPONSE_CACHE_BUDGET_BYTES:
+                response_cache_stats["bytes"] -= cached_bytes(response_cache.popitem(last = False)[1])
+    return view_response(body, gzip_body, status, etag)
 
 #########################################################################
 #########################################################################
@@ -564,11 +1702,13 @@ def add_product():
     json_list_products: list = [(json_dict["name"], json_dict["quantity"]) for json_dict in json_data]
     json_list_transactions: list = [(json_dict["name"], json_dict["name"], json_dict["quantity"]) for json_dict in json_data]
 
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.executemany("INSERT INTO products (name, quantity) VALUES (?, ?)", json_list_products)
-        cursor.executemany("INSERT INTO transactions (product_id, product_name, quantity, client_id, client_name, type_of_transaction) VALUES ((SELECT id FROM products WHERE name = ?), ?, ?, '0', 'admin', 'add')", json_list_transactions)
-        conn.commit()
+    _, error = write_statements(
+        ("products", "transactions"),
+        ("INSERT INTO products (name, quantity) VALUES (?, ?)", json_list_products),
+        ("INSERT INTO transactions (product_id, product_name, quantity, client_id, client_name, type_of_transaction) VALUES ((SELECT id FROM products WHERE name = ?), ?, ?, '0', 'admin', 'add')", json_list_transactions),
+    )
+    if error:
+        return jsonify(error), 503
         
     if not sql_product_duplicates:
         return jsonify({"message": "Task successful"}), 201
@@ -597,11 +1737,13 @@ def remove_product():
         return jsonify({"error": "No match found with any of the product names"}), 404
     
     sql_tuple_products: list = [(sql_tuple[0],) for sql_tuple in sql_product_duplicates]
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.executemany("DELETE FROM products WHERE id = ?", sql_tuple_products)
-        cursor.executemany("INSERT INTO transactions (product_id, product_name, quantity, client_id, client_name, type_of_transaction) VALUES (?, ?, ?, '0', 'admin', 'remove')", sql_product_duplicates)
-        conn.commit()
+    _, error = write_statements(
+        ("products", "transactions"),
+        ("DELETE FROM products WHERE id = ?", sql_tuple_products),
+        ("INSERT INTO transactions (product_id, product_name, quantity, client_id, client_name, type_of_transaction) VALUES (?, ?, ?, '0', 'admin', 'remove')", sql_product_duplicates),
+    )
+    if error:
+        return jsonify(error), 503
 
     if len(json_data) == len(sql_product_duplicates):
         return jsonify({"message": "Product/s deleted successfully"}), 201
@@ -655,12 +1797,14 @@ def edit_product():
         
         transaction_list: list = [(json_dict['id'], json_dict['new name'] if 'new name' in json_dict else json_dict['name'], json_dict['new quantity'] if 'new quantity' in json_dict else json_dict['quantity'], json_dict['transaction']) for json_dict in json_match_list if 'transaction' in json_dict]
 
-        with sqlite3.connect(DATABASE) as conn:
-            cursor = conn.cursor()
-            cursor.executemany("UPDATE products SET name = ? WHERE id = ?", new_name_products)
-            cursor.executemany("UPDATE products SET quantity = ? WHERE id = ?", new_quantity_products)
-            cursor.executemany("INSERT INTO transactions (product_id, product_name, quantity, client_id,client_name, type_of_transaction) VALUES (?, ?, ?, '0', 'admin', ?)", transaction_list)
-            conn.commit()
+        _, error = write_statements(
+            ("products", "transactions"),
+            ("UPDATE products SET name = ? WHERE id = ?", new_name_products),
+            ("UPDATE products SET quantity = ? WHERE id = ?", new_quantity_products),
+            ("INSERT INTO transactions (product_id, product_name, quantity, client_id,client_name, type_of_transaction) VALUES (?, ?, ?, '0', 'admin', ?)", transaction_list),
+        )
+        if error:
+            return jsonify(error), 503
 
         if json_skip_list and json_data:
             message_list: list = [{"message": "Update partially succesful"}, {"Successful": [json_dict for json_dict in json_match_list if 'transaction' in json_dict]}]
@@ -672,13 +1816,12 @@ def edit_product():
         return jsonify({"message": "Product information changed successfully"}), 201
 
     else:
-        with sqlite3.connect(DATABASE) as conn:
-            cursor = conn.cursor()
-            client = cursor.execute("SELECT id FROM clients WHERE name = ?", (user,)).fetchone()
-            if client == None:
-                return jsonify({"error": "Client not found"})
-            else:
-                client_id = client[0]
+        cursor = get_db().cursor()
+        client = cursor.execute("SELECT id FROM clients WHERE name = ?", (user,)).fetchone()
+        if client == None:
+            return jsonify({"error": "Client not found"})
+        else:
+            client_id = client[0]
         
         if error := verify_json_data(json_data, mandatory_keys = ['name'], semi_mandatory_keys = ['buy', 'return'], str_keys = ['name'], int_keys = ['buy', 'return']): 
             return jsonify(*error), 400
@@ -690,67 +1833,64 @@ def edit_product():
         if not json_match_list:
             return jsonify({"error": "No match found with any of the product names"}), 404
         
-        transactions_list_select: tuple = (client_id, *(json_dict["id"] for json_dict in json_match_list if 'return' in json_dict))
-        with sqlite3.connect(DATABASE) as conn:
-            cursor = conn.cursor()
-            sql_results = cursor.execute("SELECT * FROM transactions WHERE client_id = ? AND product_id IN ({0}) AND (type_of_transaction = 'buy' OR type_of_transaction = 'return')".format(' ,'.join('?' for _ in transactions_list_select[1:])), transactions_list_select).fetchall()
+        lines: list = [(json_dict, type_of_transaction) for json_dict in json_match_list for type_of_transaction in ('buy', 'return') if type_of_transaction in json_dict]
+        outcome, error = submit_write(lambda cursor: reserve_stock(cursor, lines, client_id, user), ("products", "transactions"))
+        if error:
+            return jsonify(error), 503
+
+        successful: list = []
+        rejected: list = []
+        for (json_dict, type_of_transaction), (quantity, rejection) in zip(lines, outcome):
+            line_dict: dict = {"id": json_dict['id'], "name": json_dict['name'], type_of_transaction: json_dict[type_of_transaction]}
+            if rejection:
+                rejected.append({**line_dict, "error": rejection})
+                continue
+            successful.append({**line_dict, "quantity": quantity, "transaction": type_of_transaction})
 
-        sql_transactions_result: list = [{'id': sql_tuple[2], sql_tuple[7]: sql_tuple[4]} for sql_tuple in sql_results]
-        len(sql_transactions_result) > 1 and delete_name_duplicates_in_list(sql_transactions_result, 'id', 'buy', 'return')
+        if not json_data and not rejected:
+            return jsonify({'message': "Transaction succesful"}), 200
 
-        products_list: list = []
-        transactions_insert: list = []
+        message_list: list = [{"message": "Transaction partially succesful"}, {"Successful": successful}] if successful else [{"error": "Transaction failed"}]
+        if rejected:
+            message_list.append({"Rejected": rejected})
+        if json_data:
+            message_list.append({"No match for name found": json_data})
+        return jsonify(*message_list), 200 if successful else 409
 
-        for json_dict in json_match_list:
-            if 'buy' in json_dict:
-                if json_dict['buy'] > json_dict['quantity']:
-                    return jsonify({"error": "Not enough in stock to complete transaction"}, json_dict)
-                
-                json_dict['quantity'] -= json_dict['buy']
-                json_dict['transaction'] = 'buy'
-                transactions_insert.append((json_dict['id'], json_dict['name'], json_dict['buy'], client_id, user, json_dict['transaction']))
-
-            if 'return' in json_dict:
-                transaction_dict, *_ = [sql_dict for sql_dict in sql_transactions_result if sql_dict['id'] == json_dict['id']]
-                if not transaction_dict:
-                    continue
-                if 'return' in transaction_dict:
-                    if transaction_dict['buy'] - transaction_dict['return'] < json_dict['return']:
-                        return jsonify({"error": "Return amount too high"}, json_dict, transaction_dict)
-                else:
-                    if transaction_dict['buy'] < json_dict['return']:
-                        return jsonify({"error": "Return amount too high"}, json_dict, transaction_dict)
-                    
-                json_dict['quantity'] += json_dict['return']
-                json_dict['transaction'] = 'return'
-                transactions_insert.append((json_dict['id'], json_dict['name'], json_dict['return'], client_id, user, json_dict['transaction']))
-            products_list.append((json_dict['quantity'], json_dict['id']))
-        
-        with sqlite3.connect(DATABASE) as conn:
-            cursor = conn.cursor()
-            cursor.executemany("UPDATE products SET quantity = ? WHERE id = ?", products_list)
-            cursor.executemany("INSERT INTO transactions (product_id, product_name, quantity, client_id, client_name, type_of_transaction) VALUES (?, ?, ?, ?, ?, ?)", transactions_insert)
-            conn.commit()
+## Import
 
-        if json_data:
-            return jsonify ({"message": "Transaction partially succesful"}, {"Successful": json_match_list}, {"No match for name found": json_data})
-        return jsonify({'message': "Transaction succesful"}), 200
+@app.route("/api/products/import", methods = ["POST"])
+def import_products():
+    user = verify_user(request.args, admin_required = True)
+    if 'error' in user: 
+        return jsonify(user), 401
+    if request.mimetype not in ("text/csv", "application/x-ndjson"):
+        return jsonify({"error": "Content type must be text/csv or application/x-ndjson"}), 415
+
+    summary, error = import_rows("products", {"name": "TEXT NOT NULL", "quantity": "INTEGER"}, mandatory_keys = ['name', 'quantity'], str_keys = ['name'], int_keys = ['quantity'])
+    if error:
+        return jsonify(error), 503
+    return jsonify({"message": "Import finished", **summary}), 201
 
 ## View
 
 @app.route("/api/products", methods = ["GET"])
 def view_products():
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        result_list = cursor.execute("SELECT * FROM products").fetchall()
-    if len(result_list) < 1: 
+    json = request.get_json()
+    if not wants_ndjson():
+        cache_entry, response = lookup_cached_view("any", json, ("products",))
+        if response:
+            return response
+
+    cursor = get_db().cursor()
+    if table_is_empty(cursor, "products"): 
         return jsonify({"message": "Table empty"}), 404
     
-    json = request.get_json()
+    if wants_ndjson():
+        return stream_view(json or {}, 'products')
     if not json:
-        return jsonify(display_in_json(result_list, "products"))
-
-    return jsonify(view_handler(json, result_list, 'products')), 200
+        return store_cached_view(cache_entry, display_in_json(select_filtered(cursor, "products"), "products"), 200)
+    return store_cached_view(cache_entry, view_handler(json, 'products'), 200)
 
 #########################################################################
 #########################################################################
@@ -777,10 +1917,9 @@ def add_client():
     json_data_duplicates = delete_multiple_lists_comparison(json_data, sql_name_duplicates, 'name')
 
     client_insert: list = [(json_dict['name'],) for json_dict in json_data]
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.executemany("INSERT INTO clients (name) VALUES (?)", client_insert)
-        conn.commit()
+    _, error = write_statements(("clients",), ("INSERT INTO clients (name) VALUES (?)", client_insert))
+    if error:
+        return jsonify(error), 503
     
     if not sql_name_duplicates:
         return jsonify({"message": "Task successful"}), 201
@@ -804,7 +1943,7 @@ def remove_client():
         sql_name_duplicates = duplicates_from_sql(json_data, 'name', table = "clients")
         if not sql_name_duplicates:
             return jsonify({"error": "No match found with any of the client names"}), 404
-        clients = [(sql_tuple[0]) for sql_tuple in sql_name_duplicates]
+        clients = [(sql_tuple[0],) for sql_tuple in sql_name_duplicates]
     else:
         clients = user_info(user)
         if 'error' in clients: 
@@ -812,10 +1951,9 @@ def remove_client():
         else:
             clients = [(clients[0],)]
 
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.executemany("DELETE FROM clients WHERE id = ?", clients)
-        conn.commit()
+    _, error = write_statements(("clients",), ("DELETE FROM clients WHERE id = ?", clients))
+    if error:
+        return jsonify(error), 503
 
     if "admin" in user and len(json) == len(sql_name_duplicates):
         return jsonify({"message": "Client information deleted successfully"}), 201
@@ -863,10 +2001,9 @@ def edit_client():
             return jsonify(*error), 400
         clients = [(json_dict['new name'], client_id) for json_dict in json_data] if type(json_data) == list else (json_data['new name'], client_id)
 
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.executemany("UPDATE clients SET name = ? WHERE id = ?", clients)
-        conn.commit()
+    _, error = write_statements(("clients",), ("UPDATE clients SET name = ? WHERE id = ?", clients))
+    if error:
+        return jsonify(error), 503
     
     if 'admin' not in user or (not json_skip_list and not json_data):
         return jsonify({"message": "Client information changed successfully"}), 201
@@ -880,6 +2017,21 @@ def edit_client():
 
     return jsonify({"message": "Client information changed successfully"}), 201
 
+## Import
+
+@app.route("/api/clients/import", methods = ["POST"])
+def import_clients():
+    user = verify_user(request.args, admin_required = True)
+    if 'error' in user: 
+        return jsonify(user), 401
+    if request.mimetype not in ("text/csv", "application/x-ndjson"):
+        return jsonify({"error": "Content type must be text/csv or application/x-ndjson"}), 415
+
+    summary, error = import_rows("clients", {"name": "TEXT NOT NULL"}, mandatory_keys = ['name'], str_keys = ['name'])
+    if error:
+        return jsonify(error), 503
+    return jsonify({"message": "Import finished", **summary}), 201
+
 ## View
 
 @app.route("/api/clients", methods = ["GET"])
@@ -889,24 +2041,23 @@ def view_clients():
     if 'error' in user: 
         return jsonify(user), 401
 
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        if "admin" in user:
-            result_list = cursor.execute("SELECT * FROM clients").fetchall()
+    if "admin" not in user:
+        result_list = user_info(user)
+        if "error" in result_list:
+            return jsonify(result_list), 404
         else:
-            result_list = user_info(user)
-            if "error" in result_list:
-                return jsonify(result_list), 404
-            else:
-                return {"id": result_list[0], "name": result_list[1]}
+            return {"id": result_list[0], "name": result_list[1]}
 
-    if len(result_list) < 1: 
+    if wants_ndjson():
+        return stream_view(json, 'clients')
+    cache_entry, response = lookup_cached_view("admin", json, ("clients",))
+    if response:
+        return response
+
+    cursor = get_db().cursor()
+    if table_is_empty(cursor, "clients"): 
         return jsonify({"message": "Table empty"}), 404
-    
-    if not json:
-        return jsonify(display_in_json(result_list, "clients"))
-    
-    return jsonify(view_handler(json, result_list, 'clients')), 200
+    return store_cached_view(cache_entry, view_handler(json, 'clients'), 200)
 
 #########################################################################
 #########################################################################
@@ -921,19 +2072,236 @@ def view_transactions():
     if 'error' in user: 
         return jsonify(user), 401
 
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        if "admin" in user:
-            result_list = cursor.execute("SELECT * FROM transactions").fetchall()
-        else:
-            result_list = [user_info(user)]
-    if len(result_list) < 1: 
+    if not wants_ndjson():
+        cache_entry, response = lookup_cached_view("admin" if "admin" in user else user, json, ("transactions", "clients"))
+        if response:
+            return response
+
+    conditions: list = []
+    params: list = []
+    if "admin" not in user:
+        client = user_info(user)
+        if "error" in client:
+            return jsonify(client), 404
+        conditions, params = ["client_id = ?"], [client[0]]
+
+    cursor = get_db().cursor()
+    if table_is_empty(cursor, "transactions"): 
         return jsonify({"message": "Table empty"}), 404
     
-    if not json:
-        return jsonify(display_in_json(result_list, "transactions"))
-    
-    return jsonify(view_handler(json, result_list, 'transactions')), 200
+    if wants_ndjson():
+        return stream_view(json, 'transactions', conditions, params)
+    return store_cached_view(cache_entry, view_handler(json, 'transactions', conditions, params), 200)
+
+#########################################################################
+#########################################################################
+## Reports routes
+
+## View
+
+# Units bought, returned, added and removed, read from the daily rollups
+
+@app.route("/api/reports", methods = ["GET"])
+def view_reports():
+    json = request.get_json()
+    user = verify_user(json, admin_required = True)
+    if 'error' in user: 
+        return jsonify(user), 401
+    json.setdefault("group by", "product")
+    if not isinstance(json["group by"], str) or json["group by"] not in report_groups:
+        return jsonify({"error": f"Group by must be one of {', '.join(report_groups)}", "group by": json["group by"]}), 400
+    report: dict = {"from": json.get("from", "0000-01-01"), "to": json.get("to", "9999-12-31")}
+    if error := verify_json_str_values(report, "from") or verify_json_str_values(report, "to"):
+        return jsonify(error), 400
+    for key in ("from", "to"):
+        try:
+            if key in json and date.fromisoformat(report[key]).isoformat() != report[key]:
+                raise ValueError
+        except ValueError:
+            return jsonify({"error": "Dates must be YYYY-MM-DD", key: json[key]}), 400
+
+    rollup_table, group_sql, columns_sql, join_sql = report_groups[json["group by"]]
+    cache_entry, response = lookup_cached_view("admin", json, ("transactions", "products", "clients"))
+    if response:
+        return response
+
+    cursor = get_db().cursor()
+    sums_sql: str = ", ".join(f"SUM(CASE r.type_of_transaction WHEN '{type_of_transaction}' THEN r.units ELSE 0 END) AS \"{total}\"" for type_of_transaction, total in zip(rollup_transaction_types, ("bought", "returned", "added", "removed")))
+    cursor.execute(f"SELECT {columns_sql}, {sums_sql}, SUM(r.transactions) AS transactions FROM {rollup_table} r {join_sql} WHERE r.day BETWEEN ? AND ? GROUP BY {group_sql} ORDER BY {group_sql}", (report["from"], report["to"]))
+    column_names: list = [column[0] for column in cursor.description]
+    return store_cached_view(cache_entry, {**report, "group by": json["group by"], "results": [dict(zip(column_names, row)) for row in cursor.fetchall()]}, 200)
+
+#########################################################################
+#########################################################################
+## Admin routes
+
+## Indexes
+
+@app.route("/api/admin/indexes", methods = ["GET"])
+def view_index_usage():
+    json = request.get_json()
+    user = verify_user(json, admin_required = True)
+    if 'error' in user: 
+        return jsonify(user), 401
+
+    if not METRICS_ENABLED:
+        return jsonify({"error": "The report covers the statements recorded while CRUD_METRICS is on since the last restart, start the app with it on"}), 404
+
+    report: list = []
+    conn = get_db()
+    with metrics_lock:
+        statements: list = [(route, statement, sql, parameters) for route, route_statement in sorted(route_statements.items()) for statement, (sql, parameters) in route_statement.items()]
+    for route, statement, sql, parameters in statements:
+        plan: list = query_plan(conn, sql, parameters)
+        if not plan:
+            continue
+        full_scan: bool = any(full_table_scan(detail, sql) for detail in plan)
+        report.append({"route": route, "query": statement, "plan": plan, "full scan": full_scan})
+    return jsonify({"indexes": list(table_indexes), "queries": report}), 200
+
+## Response cache
+
+@app.route("/api/admin/cache", methods = ["GET"])
+def view_cache_stats():
+    json = request.get_json()
+    user = verify_user(json, admin_required = True)
+    if 'error' in user: 
+        return jsonify(user), 401
+
+    with cache_lock:
+        return jsonify({**response_cache_stats, "entries": len(response_cache), "table versions": table_versions}), 200
+
+## Archive
+
+@app.route("/api/admin/archive", methods = ["POST"])
+def archive_old_transactions():
+    json = request.get_json()
+    user = verify_user(json, admin_required = True)
+    if 'error' in user: 
+        return jsonify(user), 401
+    json.setdefault("older than days", ARCHIVE_AFTER_DAYS)
+    if error := verify_json_int_values(json, "older than days"):
+        return jsonify(error), 400
+    if json["older than days"] < 0:
+        return jsonify({"error": "Older than days must be positive", "older than days": json["older than days"]}), 400
+
+    result, error = submit_write(lambda cursor: archive_transactions(cursor, json["older than days"]), ("transactions",))
+    if error:
+        return jsonify(error), 503
+    cutoff, archived = result
+    load_table_schemes(get_db().cursor())
+    if not archived:
+        return jsonify({"message": "No transactions to archive", "cutoff": cutoff}), 200
+    return jsonify({"message": "Transactions archived", "cutoff": cutoff, "archives": archived}), 201
+
+# Without a period the archives are listed, with one it is queried like the transactions view
+
+@app.route("/api/admin/archive", methods = ["GET"])
+def view_archive():
+    json = request.get_json()
+    user = verify_user(json, admin_required = True)
+    if 'error' in user: 
+        return jsonify(user), 401
+
+    cursor = get_db().cursor()
+    if "period" not in json:
+        archives: list = []
+        for archive_table in archive_tables(cursor):
+            row_count, first_date, last_date = cursor.execute(f"SELECT COUNT(*), MIN(transaction_date), MAX(transaction_date) FROM {archive_table}").fetchone()
+            archives.append({"period": archive_table.rsplit("_", 1)[1], "transactions": row_count, "first date": first_date, "last date": last_date})
+        return jsonify({"archives": archives}), 200
+
+    archive_table: str = f"transactions_archive_{json['period']}"
+    if archive_table not in archive_tables(cursor):
+        return jsonify({"error": "Archive not found", "period": json["period"]}), 404
+    if archive_table not in table_schemes:
+        load_table_schemes(cursor)
+    return jsonify(view_handler(json, archive_table)), 200
+
+## Storage
+
+@app.route("/api/admin/storage", methods = ["GET"])
+def view_ledger_storage():
+    json = request.get_json()
+    user = verify_user(json, admin_required = True)
+    if 'error' in user: 
+        return jsonify(user), 401
+    cursor = get_db().cursor()
+    pragmas: dict = {pragma: cursor.execute(f"PRAGMA {pragma}").fetchone()[0] for pragma in connection_pragmas()}
+    return jsonify({**ledger_storage(cursor), "profile": app.config.get("STORAGE_PROFILE", STORAGE_PROFILE), "pragmas": pragmas}), 200
+
+# Move the ledger to the compact layout while the routes keep running
+
+@app.route("/api/admin/storage/compact", methods = ["POST"])
+def compact_ledger():
+    json = request.get_json()
+    user = verify_user(json, admin_required = True)
+    if 'error' in user: 
+        return jsonify(user), 401
+
+    report, error = migrate_to_compact_ledger(lambda work: submit_write(work, ("transactions",)))
+    if error:
+        return jsonify(error), 409 if "already" in error["error"] else 503
+    load_table_schemes(get_db().cursor())
+    return jsonify({"message": "Transactions moved to the compact layout", **report}), 201
+
+## Slow queries
+
+@app.route("/api/admin/slow-queries", methods = ["GET"])
+def view_slow_queries():
+    json = request.get_json()
+    user = verify_user(json, admin_required = True)
+    if 'error' in user: 
+        return jsonify(user), 401
+    if error := verify_json_int_values(json, "limit") if "limit" in json else None:
+        return jsonify(error), 400
+
+    with metrics_lock:
+        statements: list = sorted(slow_queries.values(), key = lambda totals: totals["max ms"], reverse = True)[:json.get("limit", 10)]
+        return jsonify({"threshold ms": SLOW_QUERY_MS, "log": SLOW_QUERY_LOG, "statements": statements}), 200
+
+## Metrics
+
+@app.route("/api/metrics", methods = ["GET"])
+def view_metrics():
+    if not METRICS_ENABLED:
+        return jsonify({"error": "Metrics disabled, set CRUD_METRICS=on"}), 404
+    return Response(render_metrics(), mimetype = "text/plain; version=0.0.4")
+
+## Commands
+
+# flask --app app rebuild-balances
+
+@app.cli.command("rebuild-balances")
+def rebuild_balances_command():
+    init_db()
+    with sqlite3.connect(DATABASE) as conn:
+        row_count = rebuild_purchase_balances(conn.cursor())
+    print(f"Purchase balances rebuilt, {row_count} client/product rows")
+
+# flask --app app archive-transactions --days 365
+
+@app.cli.command("archive-transactions")
+@click.option("--days", default = ARCHIVE_AFTER_DAYS, help = "Archive transactions older than this many days")
+def archive_transactions_command(days):
+    init_db()
+    with sqlite3.connect(DATABASE) as conn:
+        cutoff, archived = archive_transactions(conn.cursor(), days)
+    for archive in archived:
+        print(f"{archive['archived']} transactions before {cutoff} moved to transactions_archive_{archive['period']}")
+    print(f"Archived {sum(archive['archived'] for archive in archived)} transactions")
+
+# flask --app app compact-transactions
+
+@app.cli.command("compact-transactions")
+def compact_transactions_command():
+    init_db()
+    with sqlite3.connect(DATABASE, isolation_level = None) as conn:
+        report, error = migrate_to_compact_ledger(connection_writer(conn))
+    if error:
+        print(error["error"])
+        return
+    print(f"Transactions moved to the compact layout, {report['before']['bytes per row']} -> {report['after']['bytes per row']} bytes per row")
 
 ## Main initialization
 
@@ -0,0 +1 @@
+# Benchmarks for the routes of app.py on generated data, run with: python -m benchmarks run --sizes 10000 100000
@@ -0,0 +1,135 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from json import dumps, loads
+import app
+from benchmarks import load
+from benchmarks.dataset import generate_dataset
+from benchmarks.report import summarize, environment, compare_reports
+from benchmarks.scenarios import scenarios
+
+# Send every scenario the given number of times through the test client, one summary per scenario
+
+def run_scenarios(shape: dict, iterations: int, selected: list, seed: int, warm_cache: bool = False) -> dict:
+    client = app.app.test_client()
+    results: dict = {}
+    for name, scenario in scenarios.items():
+        if selected and name not in selected:
+            continue
+        rng = random.Random(seed)
+        latencies: list = []
+        statuses: list = []
+        cache_hits: int = app.response_cache_stats["hits"] + app.response_cache_stats["not modified"]
+        started: float = time.perf_counter()
+        for iteration in range(iterations):
+            method, path, json = scenario(rng, iteration, shape)
+            if not warm_cache:
+                app.clear_response_cache()
+            request_started: float = time.perf_counter()
+            response = client.open(path, method = method, json = json)
+            response.get_data()
+            latencies.append(time.perf_counter() - request_started)
+            statuses.append(response.status_code)
+        results[name] = summarize(latencies, statuses, time.perf_counter() - started)
+        results[name]["cache hits"] = app.response_cache_stats["hits"] + app.response_cache_stats["not modified"] - cache_hits
+        print(f"{shape['transactions']:>8} {name:<34} {results[name]['throughput']:>9.1f} req/s  p50 {results[name]['p50 ms']:>8.3f} ms  p99 {results[name]['p99 ms']:>8.3f} ms  cache hits {results[name]['cache hits']:>5}", file = sys.stderr)
+    return results
+
+# Generate each dataset size in a temporary database and measure every route on it
+
+def run_command(arguments) -> int:
+    app.STORAGE_PROFILE = arguments.profile
+    report: dict = {"environment": environment(), "iterations": arguments.iterations, "layout": arguments.layout, "profile": arguments.profile, "warm cache": arguments.warm_cache, "sizes": {}}
+    for size in arguments.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            database: str = os.path.join(directory, "bench.db")
+            started: float = time.perf_counter()
+            shape: dict = generate_dataset(database, size, arguments.seed, arguments.layout)
+            print(f"{size:>8} dataset generated in {time.perf_counter() - started:.1f} s", file = sys.stderr)
+            report["sizes"][str(size)] = run_scenarios(shape, arguments.iterations, arguments.scenario, arguments.seed, arguments.warm_cache)
+            app.clear_response_cache()
+    output: str = dumps(report, indent = 2)
+    if arguments.output:
+        with open(arguments.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+# Print the route by route difference of two reports, exit status 1 when a route regressed
+
+def compare_command(arguments) -> int:
+    with open(arguments.baseline) as file:
+        baseline: dict = loads(file.read())
+    with open(arguments.current) as file:
+        current: dict = loads(file.read())
+    lines, regressions = compare_reports(baseline, current, arguments.threshold)
+    print(f"baseline {baseline['environment']['commit']}, current {current['environment']['commit']}")
+    print("\n".join(lines))
+    if regressions:
+        print(f"{len(regressions)} route(s) regressed by more than {arguments.threshold:.0%}")
+        return 1
+    return 0
+
+# Serve a generated dataset in another process and replay the mix from concurrent workers
+
+def load_command(arguments) -> int:
+    weights: dict = load.parse_mix(arguments.mix)
+    with tempfile.TemporaryDirectory() as directory:
+        database: str = os.path.join(directory, "load.db")
+        shape: dict = generate_dataset(database, arguments.rows, arguments.seed, arguments.layout)
+        initial_stock, last_transaction_id = load.snapshot(database)
+        process, url = load.start_server(database, arguments.profile)
+        try:
+            print(f"{arguments.workers} workers on {url} for {arguments.duration} s", file = sys.stderr)
+            samples, elapsed = load.run_load(url, shape, weights, arguments.workers, arguments.duration, arguments.seed)
+        finally:
+            process.terminate()
+            process.join()
+        report: dict = {"environment": environment(), "rows": arguments.rows, "layout": arguments.layout, "profile": arguments.profile, "workers": arguments.workers, "mix": weights, **load.load_report(samples, elapsed, summarize)}
+        report["consistency"] = load.check_consistency(database, initial_stock, last_transaction_id)
+    output: str = dumps(report, indent = 2)
+    if arguments.output:
+        with open(arguments.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+    return 0 if report["consistency"]["consistent"] else 1
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog = "python -m benchmarks", description = "Measure the routes of app.py on generated data")
+    commands = parser.add_subparsers(dest = "command", required = True)
+    run_parser = commands.add_parser("run", help = "generate datasets and write a json report")
+    run_parser.add_argument("--sizes", type = int, nargs = "+", default = [10000, 100000, 1000000], help = "transaction rows of each dataset")
+    run_parser.add_argument("--iterations", type = int, default = 200, help = "requests sent per scenario")
+    run_parser.add_argument("--scenario", action = "append", choices = list(scenarios), help = "only run this scenario, can be repeated")
+    run_parser.add_argument("--seed", type = int, default = 0)
+    run_parser.add_argument("--layout", choices = ["text", "compact"], default = "text", help = "transactions storage layout")
+    run_parser.add_argument("--warm-cache", action = "store_true", help = "keep the response cache between requests")
+    run_parser.add_argument("--profile", choices = list(app.storage_profiles), default = "balanced", help = "storage profile of the connections")
+    run_parser.add_argument("--output", help = "report file, printed when left out")
+    compare_parser = commands.add_parser("compare", help = "compare two reports")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type = float, default = 0.10, help = "allowed p95/throughput change, 0.10 for 10%%")
+    load_parser = commands.add_parser("load", help = "concurrent buys, returns, views and edits against a threaded server")
+    load_parser.add_argument("--rows", type = int, default = 100000, help = "transaction rows of the dataset")
+    load_parser.add_argument("--workers", type = int, default = 16)
+    load_parser.add_argument("--duration", type = float, default = 10.0, help = "seconds of load")
+    load_parser.add_argument("--mix", default = "buy=50,return=20,view=25,edit=5", help = "weights of buy, return, view and edit")
+    load_parser.add_argument("--seed", type = int, default = 0)
+    load_parser.add_argument("--layout", choices = ["text", "compact"], default = "text", help = "transactions storage layout")
+    load_parser.add_argument("--profile", choices = list(app.storage_profiles), default = "balanced", help = "storage profile of the connections")
+    load_parser.add_argument("--output", help = "report file, printed when left out")
+    arguments = parser.parse_args()
+    if arguments.command == "run":
+        return run_command(arguments)
+    if arguments.command == "load":
+        return load_command(arguments)
+    return compare_command(arguments)
+
+if __name__ == '__main__':
+    sys.exit(main())
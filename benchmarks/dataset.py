@@ -0,0 +1,61 @@
+import random
+import sqlite3
+import app
+
+# Generated names follow a fixed pattern so scenarios can pick existing rows without reading them back
+
+def product_name(index: int) -> str:
+    return f"product {index:07d}"
+
+def client_name(index: int) -> str:
+    return f"client {index:07d}"
+
+# Catalog and client counts scale with the ledger size, one product per 100 transactions and one client per 20
+
+def dataset_shape(rows: int) -> dict:
+    return {"products": max(rows // 100, 100), "clients": max(rows // 20, 50), "transactions": rows}
+
+# Fill an empty database with products, clients and a buy/return ledger
+
+def generate_dataset(database: str, rows: int, seed: int = 0, layout: str = "text") -> dict:
+    rng = random.Random(seed)
+    shape: dict = dataset_shape(rows)
+    app.DATABASE = database
+    app.init_db()
+    with sqlite3.connect(database) as conn:
+        cursor = conn.cursor()
+        cursor.executemany("INSERT INTO products (id, name, quantity) VALUES (?, ?, ?)", ((index, product_name(index), rng.randint(1000, 100000)) for index in range(1, shape["products"] + 1)))
+        cursor.executemany("INSERT INTO clients (id, name) VALUES (?, ?)", ((index, client_name(index)) for index in range(1, shape["clients"] + 1)))
+        cursor.executemany("INSERT INTO transactions (transaction_date, transaction_time, product_id, product_name, quantity, client_id, client_name, type_of_transaction) VALUES (date(?, 'unixepoch'), ?, ?, ?, ?, ?, ?, ?)", ledger_rows(rng, shape))
+        app.rebuild_purchase_balances(cursor)
+        shape["returnable"] = cursor.execute("SELECT client_id, product_id FROM purchase_balances WHERE bought - returned > 0 ORDER BY random() LIMIT 1000").fetchall()
+        cursor.execute("ANALYZE")
+        conn.commit()
+    if layout == "compact":
+        compact_ledger(database)
+    app.init_db()
+    return shape
+
+# Move the generated ledger to the compact layout, each chunk committed on its own like the online migration
+
+def compact_ledger(database: str) -> dict:
+    with sqlite3.connect(database, isolation_level = None) as conn:
+        report, _ = app.migrate_to_compact_ledger(app.connection_writer(conn))
+    return report
+
+# Transactions in time order over 2024, returns only for units left to return
+
+def ledger_rows(rng: random.Random, shape: dict):
+    balances: dict = {}
+    for index in range(shape["transactions"]):
+        client_id: int = rng.randint(1, shape["clients"])
+        product_id: int = rng.randint(1, shape["products"])
+        balance: int = balances.get((client_id, product_id), 0)
+        if balance and rng.random() < 0.15:
+            quantity, type_of_transaction = rng.randint(1, balance), "return"
+            balances[(client_id, product_id)] = balance - quantity
+        else:
+            quantity, type_of_transaction = rng.randint(1, 5), "buy"
+            balances[(client_id, product_id)] = balance + quantity
+        transaction_time: int = 1704067200 + index * 365 * 86400 // shape["transactions"]
+        yield (transaction_time, transaction_time, product_id, product_name(product_id), quantity, client_id, client_name(client_id), type_of_transaction)
@@ -0,0 +1,137 @@
+import http.client
+import multiprocessing
+import random
+import sqlite3
+import threading
+import time
+from json import dumps
+from urllib.parse import urlsplit
+from benchmarks import scenarios
+
+# Operations of the load mix and the scenarios each one draws its requests from
+
+operations: dict = {
+    "buy": [scenarios.client_buy],
+    "return": [scenarios.client_return],
+    "view": [scenarios.view_product_equal, scenarios.view_product_contains, scenarios.view_product_ordered_page, scenarios.view_transactions_client, scenarios.view_transactions_admin_filter],
+    "edit": [scenarios.edit_product],
+}
+
+# Parse a mix like "buy=50,return=20,view=25,edit=5" into operation weights
+
+def parse_mix(mix: str) -> dict:
+    weights: dict = {}
+    for part in mix.split(","):
+        operation, _, weight = part.partition("=")
+        if operation.strip() not in operations:
+            raise ValueError(f"Unknown operation {operation!r}, use {', '.join(operations)}")
+        weights[operation.strip()] = float(weight or 1)
+    return weights
+
+# Serve the app with the threaded werkzeug server in a process of its own, the chosen port is sent back
+
+def serve(database: str, profile: str, ports) -> None:
+    import logging
+    from werkzeug.serving import make_server
+    import app
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    app.DATABASE = database
+    app.STORAGE_PROFILE = profile
+    app.init_db()
+    server = make_server("127.0.0.1", 0, app.app, threaded = True)
+    ports.put(server.server_port)
+    server.serve_forever()
+
+def start_server(database: str, profile: str = "balanced") -> tuple:
+    context = multiprocessing.get_context("spawn")
+    ports = context.Queue()
+    process = context.Process(target = serve, args = (database, profile, ports), daemon = True)
+    process.start()
+    return process, f"http://127.0.0.1:{ports.get(timeout = 60)}"
+
+# One worker sends requests of the mix until the deadline, a 503 is the app giving up on a busy database
+
+def run_worker(url: str, shape: dict, weights: dict, deadline: float, seed: int, samples: list) -> None:
+    rng = random.Random(seed)
+    address = urlsplit(url)
+    names: list = list(weights)
+    iteration: int = 0
+    while time.monotonic() < deadline:
+        operation: str = rng.choices(names, weights = [weights[name] for name in names])[0]
+        method, path, json = rng.choice(operations[operation])(rng, iteration, shape)
+        iteration += 1
+        started: float = time.perf_counter()
+        try:
+            conn = http.client.HTTPConnection(address.hostname, address.port, timeout = 30)
+            conn.request(method, path, body = dumps(json), headers = {"Content-Type": "application/json"})
+            response = conn.getresponse()
+            response.read()
+            status: int = response.status
+            conn.close()
+        except (OSError, http.client.HTTPException):
+            status = 599
+        samples.append((operation, time.perf_counter() - started, status))
+
+# Run the workers concurrently against the server and collect (operation, latency, status) samples
+
+def run_load(url: str, shape: dict, weights: dict, workers: int, duration: float, seed: int) -> tuple:
+    samples: list = []
+    deadline: float = time.monotonic() + duration
+    threads: list = [threading.Thread(target = run_worker, args = (url, shape, weights, deadline, seed + index, samples)) for index in range(workers)]
+    started: float = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - started
+
+# Check the stock and purchase balances against the ledger written during the load
+
+def check_consistency(database: str, initial_stock: dict, last_transaction_id: int) -> dict:
+    with sqlite3.connect(database) as conn:
+        expected: dict = dict(initial_stock)
+        ledger = conn.execute("SELECT product_id, quantity, type_of_transaction FROM transactions WHERE transaction_id > ? ORDER BY transaction_id", (last_transaction_id,))
+        for product_id, quantity, type_of_transaction in ledger:
+            if type_of_transaction == "buy":
+                expected[product_id] -= quantity
+            elif type_of_transaction == "return":
+                expected[product_id] += quantity
+            elif type_of_transaction == "remove":
+                expected.pop(product_id, None)
+            else:
+                expected[product_id] = quantity
+        actual: dict = dict(conn.execute("SELECT id, quantity FROM products"))
+        stock_mismatches: list = [{"id": product_id, "expected": expected.get(product_id), "actual": actual.get(product_id)} for product_id in expected.keys() | actual.keys() if expected.get(product_id) != actual.get(product_id)]
+        ledger_balances: str = "SELECT client_id, product_id, SUM(CASE type_of_transaction WHEN 'buy' THEN quantity ELSE 0 END), SUM(CASE type_of_transaction WHEN 'return' THEN quantity ELSE 0 END) FROM transactions WHERE type_of_transaction IN ('buy', 'return') GROUP BY client_id, product_id"
+        balance_mismatches: int = conn.execute(f"SELECT COUNT(*) FROM (SELECT client_id, product_id, bought, returned FROM purchase_balances EXCEPT {ledger_balances})").fetchone()[0]
+        balance_mismatches += conn.execute(f"SELECT COUNT(*) FROM ({ledger_balances} EXCEPT SELECT client_id, product_id, bought, returned FROM purchase_balances)").fetchone()[0]
+        negative_stock: int = conn.execute("SELECT COUNT(*) FROM products WHERE quantity < 0").fetchone()[0]
+        negative_balances: int = conn.execute("SELECT COUNT(*) FROM purchase_balances WHERE bought < returned").fetchone()[0]
+    return {
+        "consistent": not stock_mismatches and not balance_mismatches and not negative_stock and not negative_balances,
+        "stock mismatches": len(stock_mismatches),
+        "stock mismatch examples": sorted(stock_mismatches, key = lambda mismatch: mismatch["id"])[:10],
+        "balance mismatches": balance_mismatches,
+        "negative stock": negative_stock,
+        "negative balances": negative_balances,
+    }
+
+# Stock and last ledger row before the load, the starting point of the consistency check
+
+def snapshot(database: str) -> tuple:
+    with sqlite3.connect(database) as conn:
+        initial_stock: dict = dict(conn.execute("SELECT id, quantity FROM products"))
+        last_transaction_id: int = conn.execute("SELECT COALESCE(MAX(transaction_id), 0) FROM transactions").fetchone()[0]
+    return initial_stock, last_transaction_id
+
+# Busy and error rates next to the latency summary of every operation and of the whole mix
+
+def load_report(samples: list, elapsed: float, summarize) -> dict:
+    report: dict = {"overall": summarize([latency for _, latency, _ in samples], [status for _, _, status in samples], elapsed), "operations": {}}
+    for operation in sorted({operation for operation, _, _ in samples}):
+        operation_samples: list = [(latency, status) for name, latency, status in samples if name == operation]
+        report["operations"][operation] = summarize([latency for latency, _ in operation_samples], [status for _, status in operation_samples], elapsed)
+    total: int = len(samples) or 1
+    report["busy rate"] = round(sum(1 for _, _, status in samples if status == 503) / total, 4)
+    report["error rate"] = round(sum(1 for _, _, status in samples if status >= 500 and status != 503) / total, 4)
+    return report
@@ -0,0 +1,55 @@
+import math
+import platform
+import sqlite3
+import subprocess
+
+# Nearest rank percentile of already sorted latencies
+
+def percentile(sorted_latencies: list, rank: float) -> float:
+    if not sorted_latencies:
+        return 0.0
+    return sorted_latencies[max(math.ceil(rank / 100 * len(sorted_latencies)) - 1, 0)]
+
+# Throughput and latency percentiles in milliseconds for one measured route, status codes counted by class
+
+def summarize(latencies: list, statuses: list, elapsed: float) -> dict:
+    sorted_latencies: list = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "mean ms": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+        "p50 ms": round(percentile(sorted_latencies, 50) * 1000, 3),
+        "p95 ms": round(percentile(sorted_latencies, 95) * 1000, 3),
+        "p99 ms": round(percentile(sorted_latencies, 99) * 1000, 3),
+        "max ms": round(sorted_latencies[-1] * 1000, 3) if sorted_latencies else 0.0,
+        "client errors": sum(1 for status in statuses if 400 <= status < 500),
+        "server errors": sum(1 for status in statuses if status >= 500),
+    }
+
+# Where the report was measured, so two reports are only compared knowingly
+
+def environment() -> dict:
+    try:
+        commit: str = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "sqlite": sqlite3.sqlite_version, "machine": platform.machine()}
+
+# Compare two reports route by route, a route regresses when its p95 grows or its throughput drops by more than the threshold
+
+def compare_reports(baseline: dict, current: dict, threshold: float) -> tuple:
+    lines: list = []
+    regressions: list = []
+    for size, routes in current["sizes"].items():
+        for route, result in routes.items():
+            base = baseline["sizes"].get(size, {}).get(route)
+            if not base:
+                lines.append(f"{size:>8} {route:<34} new")
+                continue
+            p95_change: float = result["p95 ms"] / base["p95 ms"] - 1 if base["p95 ms"] else 0.0
+            throughput_change: float = result["throughput"] / base["throughput"] - 1 if base["throughput"] else 0.0
+            regressed: bool = p95_change > threshold or throughput_change < -threshold
+            lines.append(f"{size:>8} {route:<34} p95 {base['p95 ms']:>9.3f} -> {result['p95 ms']:>9.3f} ms ({p95_change:+.1%})  throughput {throughput_change:+.1%}{'  REGRESSION' if regressed else ''}")
+            if regressed:
+                regressions.append((size, route))
+    return lines, regressions
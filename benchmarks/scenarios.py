@@ -0,0 +1,99 @@
+import random
+from benchmarks.dataset import product_name, client_name
+
+# Each scenario builds one request from a random generator, the iteration number and the dataset shape,
+# returning (method, path, json), read scenarios come first since the write scenarios change the data
+
+def view_product_equal(rng: random.Random, iteration: int, shape: dict) -> tuple:
+    return "GET", "/api/products", {"filter": {"name": product_name(rng.randint(1, shape["products"]))}}
+
+def view_product_contains(rng: random.Random, iteration: int, shape: dict) -> tuple:
+    return "GET", "/api/products", {"filter": {"name": [f"{rng.randint(0, 99999):05d}", "**"]}}
+
+def view_product_starts_with(rng: random.Random, iteration: int, shape: dict) -> tuple:
+    return "GET", "/api/products", {"filter": {"name": [f"product {rng.randint(0, 999):03d}", "*a"]}}
+
+def view_product_ends_with(rng: random.Random, iteration: int, shape: dict) -> tuple:
+    return "GET", "/api/products", {"filter": {"name": [f"{rng.randint(0, 999):03d}", "a*"]}}
+
+def view_product_range(rng: random.Random, iteration: int, shape: dict) -> tuple:
+    low: int = rng.randint(1000, 99000)
+    return "GET", "/api/products", {"filter": {"quantity": [low, low + 500, "--"]}}
+
+def view_product_greater(rng: random.Random, iteration: int, shape: dict) -> tuple:
+    return "GET", "/api/products", {"filter": {"quantity": [rng.randint(99000, 100000), "<="]}, "limit": 100}
+
+def view_product_less(rng: random.Random, iteration: int, shape: dict) -> tuple:
+    return "GET", "/api/products", {"filter": {"quantity": [rng.randint(1000, 2000), ">="]}, "limit": 100}
+
+def view_product_multiple(rng: random.Random, iteration: int, shape: dict) -> tuple:
+    return "GET", "/api/products", {"filter": [{"name": product_name(rng.randint(1, shape["products"]))}, {"id": rng.randint(1, shape["products"])}]}
+
+def view_product_ordered_page(rng: random.Random, iteration: int, shape: dict) -> tuple:
+    return "GET", "/api/products", {"order": {"column": "quantity", "descending": True}, "limit": 100, "offset": rng.randint(0, 10) * 100}
+
+def view_client(rng: random.Random, iteration: int, shape: dict) -> tuple:
+    return "GET", "/api/clients", {"user": "admin", "filter": {"name": client_name(rng.randint(1, shape["clients"]))}}
+
+def view_transactions_client(rng: random.Random, iteration: int, shape: dict) -> tuple:
+    return "GET", "/api/transactions", {"user": client_name(rng.randint(1, shape["clients"]))}
+
+def view_transactions_admin_filter(rng: random.Random, iteration: int, shape: dict) -> tuple:
+    return "GET", "/api/transactions", {"user": "admin", "filter": {"client_id": rng.randint(1, shape["clients"])}, "limit": 100}
+
+def view_transactions_date_range(rng: random.Random, iteration: int, shape: dict) -> tuple:
+    day: int = rng.randint(1, 28)
+    return "GET", "/api/transactions", {"user": "admin", "filter": {"transaction_date": [f"2024-03-{day:02d}", f"2024-04-{day:02d}", "--"]}, "limit": 100}
+
+def view_transactions_day(rng: random.Random, iteration: int, shape: dict) -> tuple:
+    return "GET", "/api/transactions", {"user": "admin", "filter": {"transaction_date": [f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}", "=="]}, "limit": 100}
+
+def add_product(rng: random.Random, iteration: int, shape: dict) -> tuple:
+    return "POST", "/api/products/add", {"user": "admin", "data": [{"name": f"bench product {iteration:07d}", "quantity": 100}]}
+
+def edit_product(rng: random.Random, iteration: int, shape: dict) -> tuple:
+    return "POST", "/api/products/edit", {"user": "admin", "data": [{"name": product_name(rng.randint(1, shape["products"])), "new quantity": rng.randint(1000, 100000)}]}
+
+def client_buy(rng: random.Random, iteration: int, shape: dict) -> tuple:
+    return "POST", "/api/products/edit", {"user": client_name(rng.randint(1, shape["clients"])), "data": [{"name": product_name(rng.randint(1, shape["products"])), "buy": rng.randint(1, 3)}]}
+
+def client_return(rng: random.Random, iteration: int, shape: dict) -> tuple:
+    client_id, product_id = rng.choice(shape["returnable"])
+    return "POST", "/api/products/edit", {"user": client_name(client_id), "data": [{"name": product_name(product_id), "return": 1}]}
+
+def remove_product(rng: random.Random, iteration: int, shape: dict) -> tuple:
+    return "POST", "/api/products/remove", {"user": "admin", "data": [{"name": f"bench product {iteration:07d}"}]}
+
+def add_client(rng: random.Random, iteration: int, shape: dict) -> tuple:
+    return "POST", "/api/clients/add", {"user": "admin", "data": [{"name": f"bench client {iteration:07d}"}]}
+
+def edit_client(rng: random.Random, iteration: int, shape: dict) -> tuple:
+    return "POST", "/api/clients/edit", {"user": f"bench client {iteration:07d}", "data": [{"new name": f"bench renamed {iteration:07d}"}]}
+
+def remove_client(rng: random.Random, iteration: int, shape: dict) -> tuple:
+    return "POST", "/api/clients/remove", {"user": "admin", "data": [{"name": f"bench renamed {iteration:07d}"}]}
+
+scenarios: dict = {
+    "view products ==": view_product_equal,
+    "view products **": view_product_contains,
+    "view products *a": view_product_starts_with,
+    "view products a*": view_product_ends_with,
+    "view products --": view_product_range,
+    "view products <=": view_product_greater,
+    "view products >=": view_product_less,
+    "view products multiple filters": view_product_multiple,
+    "view products ordered page": view_product_ordered_page,
+    "view clients": view_client,
+    "view transactions client": view_transactions_client,
+    "view transactions admin filter": view_transactions_admin_filter,
+    "view transactions date range": view_transactions_date_range,
+    "view transactions day": view_transactions_day,
+    "add products": add_product,
+    "edit products admin": edit_product,
+    "client buy": client_buy,
+    "client return": client_return,
+    "remove products": remove_product,
+    "add clients": add_client,
+    "edit clients": edit_client,
+    "remove clients": remove_client,
+}